@@ -0,0 +1,98 @@
+import numpy as np
+
+# Upper bound on the number of ray/sphere pairs evaluated at once, so a frame
+# against a big scene doesn't build one enormous (rays x spheres) matrix.
+CHUNK_PAIRS = 1 << 20
+
+# Reflection and shadow rays start on the surface of the object they left.
+# A hit with that object only counts if the ray travels at least this far
+# inside it, same rule as the per-object loop in Scene.findIntersect.
+SELF_INTERSECT_LENGTH = 0.2
+
+# Vectorized version of euclid._intersect_line3_sphere for rays.
+# origins, directions: (N, 3) arrays. centres: (M, 3), radii: (M,).
+# exclude: optional (N,) int array, the sphere index each ray left from or -1.
+# Returns (t, index): for each ray the parameter of the nearest hit along its
+# direction (inf on a miss) and the index of the sphere hit (-1 on a miss).
+# The arithmetic follows euclid step by step so the two agree bit for bit.
+def intersectSpheres(origins, directions, centres, radii, exclude=None):
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    centres = np.asarray(centres, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+    n, m = len(origins), len(radii)
+    t = np.full(n, np.inf)
+    index = np.full(n, -1, dtype=np.intp)
+    if n == 0 or m == 0:
+        return t, index
+    if exclude is not None:
+        exclude = np.asarray(exclude, dtype=np.intp).reshape(-1)
+
+    cx, cy, cz = centres[:, 0], centres[:, 1], centres[:, 2]
+    cc = cx ** 2 + cy ** 2 + cz ** 2
+    rr = radii ** 2
+    columns = np.arange(m)
+    step = max(1, CHUNK_PAIRS // m)
+    for start in xrange(0, n, step):
+        stop = min(n, start + step)
+        p = origins[start:stop, :, np.newaxis]
+        v = directions[start:stop, :, np.newaxis]
+        px, py, pz = p[:, 0], p[:, 1], p[:, 2]
+        vx, vy, vz = v[:, 0], v[:, 1], v[:, 2]
+        a = vx ** 2 + vy ** 2 + vz ** 2
+        b = 2 * (vx * (px - cx) + vy * (py - cy) + vz * (pz - cz))
+        c = cc + (px ** 2 + py ** 2 + pz ** 2) - 2 * (cx * px + cy * py + cz * pz) - rr
+        det = b ** 2 - 4 * a * c
+        hit = det >= 0
+        sq = np.sqrt(np.where(hit, det, 0.0))
+        u1 = (-b + sq) / (2 * a)
+        u2 = np.maximum((-b - sq) / (2 * a), 0.0)
+        hit &= u1 >= u2
+        if exclude is not None:
+            own = columns == exclude[start:stop, np.newaxis]
+            inside = (u1 - u2) * np.sqrt(a)
+            hit &= ~(own & (inside < SELF_INTERSECT_LENGTH))
+        near = np.where(hit, u2, np.inf)
+        best = near.argmin(axis=1)
+        rows = np.arange(stop - start)
+        t[start:stop] = near[rows, best]
+        index[start:stop] = np.where(np.isinf(t[start:stop]), -1, best)
+    return t, index
+
+# Vectorized version of euclid._intersect_line3_plane for rays.
+# origins, directions: (N, 3) arrays. normals: (M, 3), offsets: (M,), the
+# planes being normal . p = offset. exclude: optional (N,) int array, the
+# plane index each ray left from or -1; a ray never hits the plane it left.
+# Returns (t, index) like intersectSpheres.
+def intersectPlanes(origins, directions, normals, offsets, exclude=None):
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+    offsets = np.asarray(offsets, dtype=np.float64).reshape(-1)
+    n, m = len(origins), len(offsets)
+    t = np.full(n, np.inf)
+    index = np.full(n, -1, dtype=np.intp)
+    if n == 0 or m == 0:
+        return t, index
+    if exclude is not None:
+        exclude = np.asarray(exclude, dtype=np.intp).reshape(-1)
+
+    nx, ny, nz = normals[:, 0], normals[:, 1], normals[:, 2]
+    columns = np.arange(m)
+    step = max(1, CHUNK_PAIRS // m)
+    for start in xrange(0, n, step):
+        stop = min(n, start + step)
+        p = origins[start:stop, :, np.newaxis]
+        v = directions[start:stop, :, np.newaxis]
+        d = nx * v[:, 0] + ny * v[:, 1] + nz * v[:, 2]
+        hit = d != 0
+        u = (offsets - (nx * p[:, 0] + ny * p[:, 1] + nz * p[:, 2])) / np.where(hit, d, 1.0)
+        hit &= u >= 0.0
+        if exclude is not None:
+            hit &= columns != exclude[start:stop, np.newaxis]
+        near = np.where(hit, u, np.inf)
+        best = near.argmin(axis=1)
+        rows = np.arange(stop - start)
+        t[start:stop] = near[rows, best]
+        index[start:stop] = np.where(np.isinf(t[start:stop]), -1, best)
+    return t, index
@@ -0,0 +1,229 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import Queue
+import random
+import resource
+import sys
+from time import time
+
+import euclid
+from shapes import RaycastingSphere, RaycastingPlane
+from raytrace import Scene, render
+from lights import PointLight
+
+# Throughput benchmark over a fixed set of scenes.
+# Every case (scene x resolution x depth x mode) runs in a fresh process so
+# the peak memory reported is that case's own. Results are printed (or
+# written to --output) as JSON.
+
+SEED = 1234
+
+# How often (seconds) runIsolated checks whether a case's process died.
+POLL_SECONDS = 1.0
+
+# Scene builders add their objects to an empty Scene.
+
+# Four spheres, as rendered by raytrace.py's __main__.
+def demoScene(scene):
+    scene.objects.append(RaycastingSphere(euclid.Point3(-50, 0, 0), 2.0))
+    scene.objects[-1].reflectionIndex = 0.2
+    scene.objects.append(RaycastingSphere(euclid.Point3(-55, 2, 0), 1.0))
+    scene.objects[-1].reflectionIndex = 0.2
+    scene.objects.append(RaycastingSphere(euclid.Point3(-55, 8, -2), 3.0))
+    scene.objects[-1].reflectionIndex = 0.1
+    scene.objects.append(RaycastingSphere(euclid.Point3(-55, 2, -5), 2.0))
+    scene.objects[-1].color = (255,0,0)
+
+# n spheres scattered through the view, sized so that the cloud stays about
+# equally dense whatever n is.
+def randomSpheres(scene, n, reflective=0.3):
+    rng = random.Random(SEED)
+    radius = 6.0 / n ** (1.0 / 3)
+    for i in xrange(n):
+        c = euclid.Point3(rng.uniform(-90, -40), rng.uniform(-20, 20), rng.uniform(-20, 20))
+        scene.objects.append(RaycastingSphere(c, radius * rng.uniform(0.5, 1.5)))
+        scene.objects[-1].color = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+        if rng.random() < reflective:
+            scene.objects[-1].reflectionIndex = 0.3
+
+# The demo spheres above a reflective checkered floor, lit from above them.
+# Scene.light's shadow rays go on past it, so the floor is the only plane:
+# any other would shadow everything on the far side of the light.
+def planeScene(scene):
+    demoScene(scene)
+    scene.objects.append(RaycastingPlane((0,0,0), euclid.Point3(0, 0, 5)))
+    scene.objects[-1].reflectionIndex = 0.2
+    scene.light = euclid.Point3(-40, 0, -20)
+
+# A lattice of strongly reflective spheres; rays bounce between them until
+# the depth runs out.
+def mirrorScene(scene):
+    for i in xrange(4):
+        for j in xrange(-3, 4):
+            for k in xrange(-3, 4):
+                scene.objects.append(RaycastingSphere(euclid.Point3(-45 - 6 * i, 5 * j, 5 * k), 2.0))
+                scene.objects[-1].reflectionIndex = 0.9
+
+# The plane scene lit by n point lights scattered above the floor, most of
+# which only light a small patch of it.
+def manyLights(scene, n):
+    planeScene(scene)
+    rng = random.Random(SEED)
+    for i in xrange(n):
+        p = euclid.Point3(rng.uniform(-90, -30), rng.uniform(-30, 30), rng.uniform(-10, 4))
+        scene.lights.append(PointLight(p, rng.uniform(0.2, 1.0), rng.uniform(0.5, 3.0)))
+    scene.buildLightGrid()
+
+SCENES = {
+    'demo': demoScene,
+    'spheres1k': lambda scene: randomSpheres(scene, 1000),
+    'spheres10k': lambda scene: randomSpheres(scene, 10000),
+    'spheres100k': lambda scene: randomSpheres(scene, 100000),
+    'planes': planeScene,
+    'mirrors': mirrorScene,
+    'lights': lambda scene: manyLights(scene, 300),
+}
+
+def useWavefront(scene):
+    scene.compile()
+    scene.wavefront = True
+
+# How the scene is prepared before rendering.
+MODES = {
+    'plain': lambda scene: None,
+    'compiled': lambda scene: scene.compile(),
+    'wavefront': lambda scene: useWavefront(scene),
+    'bvh': lambda scene: scene.buildBVH(),
+    'grid': lambda scene: scene.buildGrid(),
+}
+
+def _peakMemoryKB(who):
+    # ru_maxrss is in kilobytes on Linux but bytes on OS X
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def runCase(sceneName, w, h, depth, mode, processes):
+    start = time()
+    scene = Scene(w, h)
+    SCENES[sceneName](scene)
+    built = time()
+    MODES[mode](scene)
+    prepared = time()
+    render(scene, w, h, depth, processes)
+    end = time()
+    seconds = end - prepared
+    primary = w * h
+    result = {
+        'scene': sceneName,
+        'objects': len(scene.objects),
+        'width': w,
+        'height': h,
+        'depth': depth,
+        'mode': mode,
+        'processes': processes,
+        'sceneSeconds': built - start,
+        'prepareSeconds': prepared - built,
+        'renderSeconds': seconds,
+        'primaryRays': primary,
+        'primaryRaysPerSecond': primary / seconds,
+        'peakMemoryKB': _peakMemoryKB(resource.RUSAGE_SELF),
+        'peakWorkerMemoryKB': _peakMemoryKB(resource.RUSAGE_CHILDREN),
+    }
+    if scene.compiled is not None:
+        result['compiledBytes'] = scene.compiled.nbytes()
+    counters = scene.stats.rays
+    result['totalRays'] = counters.total()
+    result['borderRays'] = counters.border
+    result['reflectionRays'] = counters.reflection
+    result['shadowRays'] = counters.shadow
+    result['prunedRays'] = counters.pruned
+    result['culledLights'] = counters.culled
+    result['totalRaysPerSecond'] = counters.total() / seconds
+    result['intersectionTests'] = dict(counters.tests)
+    return result
+
+def _runCase(queue, args):
+    try:
+        queue.put(runCase(*args))
+    except Exception, e:
+        queue.put({'error': repr(e)})
+
+# Runs runCase(*args) in a child process and returns its result, or an
+# error if the child died without one (a signal, the OOM killer, a crash).
+def runIsolated(args):
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_runCase, args=(queue, args))
+    child.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=POLL_SECONDS)
+        except Queue.Empty:
+            if not child.is_alive():
+                break
+    if result is None:
+        # it may have put its result just before exiting
+        try:
+            result = queue.get(timeout=POLL_SECONDS)
+        except Queue.Empty:
+            pass
+    child.join()
+    if result is None:
+        result = {'error': 'exit code %d' % child.exitcode}
+    return result
+
+def _list(kind):
+    return lambda s: [kind(v) for v in s.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Raytracer throughput benchmark.")
+    parser.add_argument('--scenes', type=_list(str), default=sorted(SCENES),
+                        help="comma separated, from: " + ", ".join(sorted(SCENES)))
+    parser.add_argument('--sizes', type=_list(int), default=[32, 64],
+                        help="comma separated square image sizes in pixels")
+    parser.add_argument('--depths', type=_list(int), default=[1, 5],
+                        help="comma separated trace depths")
+    parser.add_argument('--modes', type=_list(str), default=['bvh'],
+                        help="comma separated, from: " + ", ".join(sorted(MODES)))
+    parser.add_argument('--processes', type=int, default=1,
+                        help="render processes, 0 for one per core")
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    for name in args.scenes:
+        if name not in SCENES:
+            parser.error("unknown scene " + name)
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error("unknown mode " + mode)
+    processes = args.processes or None
+
+    results = []
+    for name in args.scenes:
+        for size in args.sizes:
+            for depth in args.depths:
+                for mode in args.modes:
+                    result = runIsolated((name, size, size, depth, mode, processes))
+                    result.setdefault('scene', name)
+                    results.append(result)
+                    sys.stderr.write("%s %dx%d depth %d %s: %s\n" % (name, size, size, depth, mode,
+                        result.get('error') or "%.0f primary rays/s" % result['primaryRaysPerSecond']))
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'time': time(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print text
+
+if __name__ == "__main__":
+    main()
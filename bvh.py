@@ -0,0 +1,124 @@
+import numpy as np
+from shapes import RaycastingSphere
+
+# Bounding volume hierarchy over the spheres of a scene.
+# Nodes are kept in flat lists indexed by node number, node 0 is the root.
+# An inner node has two children; a leaf holds up to LEAF_SIZE objects.
+# Planes and anything else without finite bounds go to self.others and are
+# not part of the tree; callers test those separately.
+# The tree only finds candidates. The actual ray/object tests are done by a
+# callback, so the hit rules (self-intersection etc.) stay in one place.
+
+LEAF_SIZE = 4
+
+class BVH(object):
+    def __init__(self, objects):
+        self.objects = [o for o in objects if type(o) == RaycastingSphere]
+        self.others = [o for o in objects if type(o) != RaycastingSphere]
+        self.lo = []
+        self.hi = []
+        self.left = []
+        self.right = []
+        self.leaves = []
+        if self.objects:
+            centres = np.array([tuple(o.c) for o in self.objects], dtype=np.float64)
+            radii = np.array([o.r for o in self.objects], dtype=np.float64)[:, np.newaxis]
+            self._build(np.arange(len(self.objects)), centres, centres - radii, centres + radii)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _build(self, members, centres, lo, hi):
+        node = len(self.lo)
+        self.lo.append(tuple(lo[members].min(axis=0).tolist()))
+        self.hi.append(tuple(hi[members].max(axis=0).tolist()))
+        self.left.append(-1)
+        self.right.append(-1)
+        self.leaves.append(None)
+        if len(members) <= LEAF_SIZE:
+            self.leaves[node] = [self.objects[i] for i in members]
+            return node
+        # median split along the axis the centres spread most on
+        c = centres[members]
+        axis = (c.max(axis=0) - c.min(axis=0)).argmax()
+        members = members[c[:, axis].argsort(kind='mergesort')]
+        half = len(members) // 2
+        self.left[node] = self._build(members[:half], centres, lo, hi)
+        self.right[node] = self._build(members[half:], centres, lo, hi)
+        return node
+
+    # Slab test of ray against the box of node. Returns the ray parameter
+    # where the ray enters the box (0 if it starts inside), None on a miss.
+    def _enter(self, node, p, v):
+        lo, hi = self.lo[node], self.hi[node]
+        tmin, tmax = 0.0, float('inf')
+        for axis in xrange(3):
+            if v[axis] == 0:
+                if p[axis] < lo[axis] or p[axis] > hi[axis]:
+                    return None
+                continue
+            t1 = (lo[axis] - p[axis]) / v[axis]
+            t2 = (hi[axis] - p[axis]) / v[axis]
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > tmin:
+                tmin = t1
+            if t2 < tmax:
+                tmax = t2
+            if tmin > tmax:
+                return None
+        return tmin
+
+    # Closest hit. test(objects, ray, *args) must return (t, obj) of the
+    # nearest hit among objects like Scene.nearestIntersect, t being the ray
+    # parameter. Boxes entered beyond maxT, or beyond the best hit so far,
+    # are skipped. Returns (t, obj), obj is None if nothing closer was hit.
+    def nearest(self, ray, maxT, test, *args):
+        best = (maxT, None)
+        if not self.objects:
+            return best
+        p, v = tuple(ray.p), tuple(ray.v)
+        t = self._enter(0, p, v)
+        if t is None:
+            return best
+        stack = [(t, 0)]
+        while stack:
+            t, node = stack.pop()
+            if t > best[0]:
+                continue
+            leaf = self.leaves[node]
+            if leaf is not None:
+                hit = test(leaf, ray, *args)
+                if hit[1] is not None and hit[0] < best[0]:
+                    best = hit
+                continue
+            children = []
+            for child in (self.left[node], self.right[node]):
+                tc = self._enter(child, p, v)
+                if tc is not None:
+                    children.append((tc, child))
+            # nearer child on top of the stack
+            children.sort(reverse=True)
+            stack.extend(children)
+        return best
+
+    # Any hit. test(objects, ray, *args) returns the object of objects that
+    # blocks the ray, or None. Returns the first blocker reported, or None.
+    def anyHit(self, ray, test, *args):
+        if not self.objects:
+            return None
+        p, v = tuple(ray.p), tuple(ray.v)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._enter(node, p, v) is None:
+                continue
+            leaf = self.leaves[node]
+            if leaf is not None:
+                blocker = test(leaf, ray, *args)
+                if blocker is not None:
+                    return blocker
+                continue
+            stack.append(self.right[node])
+            stack.append(self.left[node])
+        return None
@@ -2,7 +2,9 @@ import euclid
 from euclid import Point3 as P3
 from euclid import Vector3 as V3
 from euclid import Ray3 as R3
+import copy
 import math
+import numpy as np
 
 # v is vector to be rotated, k is axis, and t is amount of rotation in radians
 def rotate(v, k, t):
@@ -40,6 +42,8 @@ class Camera(object):
         if len(focus) != 3 or type(focus) != tuple:
             raise TypeError("'focus' must be a tuple of length 3.")
         self.focus = euclid.Point3(focus[0], focus[1], focus[2])
+        # calculateRepr rotates self.focus
+        self.focus0 = self.focus.copy()
         self.FoV = float(FoV)
         self.LRAngle = math.radians(self.FoV)
         self.width = int(width)
@@ -97,14 +101,176 @@ class Camera(object):
 
     def getPixelCoords(self, w, h):
         # Slice basic vectors horiz/vert into w, h pieces and add.
-        vert = self.basic_vertical / float(w)
-        horiz = self.basic_horizontal / float(h)
-        for x in xrange(w):
-            for y in xrange(h):
-                yield x, y, self.topleft + horiz * x + vert * y 
+        horiz = self.basic_horizontal / float(w)
+        vert = self.basic_vertical / float(h)
+        # scanline order, like the rows of an image
+        for y in xrange(h):
+            for x in xrange(w):
+                yield x, y, self.topleft + horiz * x + vert * y
 
+    # Same sampling as getPixelCoords, but for a whole frame at once.
+    # tile is (x0, y0, x1, y1) in pixels, end-exclusive, and defaults to the
+    # full w*h frame. Returns ray origins and directions as two contiguous
+    # float64 arrays of shape (y1-y0, x1-x0, 3), indexed [row, column].
+    def getPrimaryRays(self, w, h, tile=None):
+        if tile is None:
+            tile = (0, 0, w, h)
+        x0, y0, x1, y1 = tile
+        horiz = np.array(tuple(self.basic_horizontal), dtype=np.float64) / float(w)
+        vert = np.array(tuple(self.basic_vertical), dtype=np.float64) / float(h)
+        xs = np.arange(x0, x1, dtype=np.float64)[np.newaxis, :, np.newaxis]
+        ys = np.arange(y0, y1, dtype=np.float64)[:, np.newaxis, np.newaxis]
+        # keep the operation order of getPixelCoords so both agree bit for bit
+        points = np.array(tuple(self.topleft), dtype=np.float64) + horiz * xs + vert * ys
+        focus = np.array(tuple(self.focus), dtype=np.float64)
+        directions = points - focus
+        origins = np.empty_like(directions)
+        origins[...] = focus
+        return origins, directions
 
+    # Rays through an n*n grid of points spread evenly over the footprint of
+    # each of the pixels xs, ys ((K,) arrays), centred on the point
+    # getPrimaryRays samples for it. Returns origins and directions of shape
+    # (K, n*n, 3).
+    def getSubpixelRays(self, w, h, xs, ys, n):
+        horiz = np.array(tuple(self.basic_horizontal), dtype=np.float64) / float(w)
+        vert = np.array(tuple(self.basic_vertical), dtype=np.float64) / float(h)
+        offsets = (np.arange(n, dtype=np.float64) + 0.5) / n - 0.5
+        xs = np.asarray(xs, dtype=np.float64)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+        ys = np.asarray(ys, dtype=np.float64)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        xs, ys = np.broadcast_arrays(xs, ys)
+        xs = xs.reshape(-1, n * n, 1)
+        ys = ys.reshape(-1, n * n, 1)
+        points = np.array(tuple(self.topleft), dtype=np.float64) + horiz * xs + vert * ys
+        focus = np.array(tuple(self.focus), dtype=np.float64)
+        directions = points - focus
+        origins = np.empty_like(directions)
+        origins[...] = focus
+        return origins, directions
 
+# Orientation of a Camera with rotation (degrees about x, then y, then z, as
+# calculateRepr applies them) as a euclid.Quaternion.
+def rotationQuaternion(rotation):
+    q = euclid.Quaternion()
+    for i in xrange(3):
+        if rotation[i] != 0:
+            axis = V3(1 if i==0 else 0, 1 if i ==1 else 0, 1 if i==2 else 0)
+            q = euclid.Quaternion.new_rotate_axis(math.radians(rotation[i]), axis) * q
+    return q
 
+# Rotation matrices of an (F, 4) array of unit quaternions (w, x, y, z), as
+# euclid.Quaternion.get_matrix makes them. Returns an (F, 3, 3) array.
+def quaternionMatrices(q):
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    m = np.empty((len(q), 3, 3))
+    m[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    m[:, 0, 1] = 2 * (x * y - z * w)
+    m[:, 0, 2] = 2 * (x * z + y * w)
+    m[:, 1, 0] = 2 * (x * y + z * w)
+    m[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    m[:, 1, 2] = 2 * (y * z - x * w)
+    m[:, 2, 0] = 2 * (x * z - y * w)
+    m[:, 2, 1] = 2 * (y * z + x * w)
+    m[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return m
 
+# Names of the points and vectors making up a Camera's representation.
+_POINTS = ('focus', 'topleft')
+_VECTORS = ('basic_horizontal', 'basic_vertical', 'L', 'R', 'D', 'T', 'B')
 
+# A camera moving through keyframes, for flythroughs.
+# keyframes are (time, rotation, translation) in increasing time. rotation
+# is a euclid.Quaternion or degrees about x, y and z like Camera takes;
+# translation moves the rotated camera. Orientation is interpolated with
+# euclid.Quaternion.new_interpolate, position linearly or, with
+# position='spline', along a Catmull-Rom spline through the keyframes.
+# Every frame shares FoV, zoom, focus and size with camera, whose own
+# rotation is ignored. The frames are worked out in one batch: matrices()
+# gives (F, 4, 4) camera-to-world transforms, cameras() Camera objects
+# set up from them without calculateRepr.
+class CameraPath(object):
+    def __init__(self, camera, keyframes, position='linear'):
+        if position not in ('linear', 'spline'):
+            raise TypeError("'position' must be 'linear' or 'spline'.")
+        if not keyframes:
+            raise TypeError("A camera path needs at least one keyframe.")
+        self.camera = camera
+        self.position = position
+        self.times = np.array([float(k[0]) for k in keyframes])
+        self.rotations = []
+        for time, rotation, translation in keyframes:
+            if not isinstance(rotation, euclid.Quaternion):
+                rotation = rotationQuaternion(rotation)
+            q = rotation.normalized()
+            # q and -q are the same rotation; keep neighbours on the same
+            # side so that new_interpolate takes the short way
+            if self.rotations:
+                p = self.rotations[-1]
+                if p.w * q.w + p.x * q.x + p.y * q.y + p.z * q.z < 0:
+                    q = euclid.Quaternion(-q.w, -q.x, -q.y, -q.z)
+            self.rotations.append(q)
+        self.translations = np.array([tuple(k[2]) for k in keyframes], dtype=np.float64)
+        # the camera's representation before any rotation
+        local = Camera(focus=tuple(camera.focus0), FoV=camera.FoV, width=camera.width,
+                       height=camera.height, zoom=camera.zoom)
+        self.points = np.array([tuple(getattr(local, name)) for name in _POINTS], dtype=np.float64)
+        self.vectors = np.array([tuple(getattr(local, name)) for name in _VECTORS], dtype=np.float64)
+
+    # Keyframe segment and position u in [0, 1] along it of every time.
+    def _segments(self, times):
+        times = np.clip(np.asarray(times, dtype=np.float64), self.times[0], self.times[-1])
+        last = len(self.times) - 1
+        i = np.clip(np.searchsorted(self.times, times, side='right') - 1, 0, max(last - 1, 0))
+        j = np.minimum(i + 1, last)
+        span = self.times[j] - self.times[i]
+        u = np.where(span > 0, (times - self.times[i]) / np.where(span > 0, span, 1.0), 0.0)
+        return i, j, u
+
+    def _translations(self, i, j, u):
+        p1, p2 = self.translations[i], self.translations[j]
+        if self.position == 'linear':
+            return p1 + (p2 - p1) * u[:, np.newaxis]
+        last = len(self.times) - 1
+        p0 = self.translations[np.maximum(i - 1, 0)]
+        p3 = self.translations[np.minimum(j + 1, last)]
+        u = u[:, np.newaxis]
+        return 0.5 * (2 * p1 + (p2 - p0) * u + (2 * p0 - 5 * p1 + 4 * p2 - p3) * u ** 2 +
+                      (3 * p1 - p0 - 3 * p2 + p3) * u ** 3)
+
+    def _quaternions(self, i, j, u):
+        q = np.empty((len(u), 4))
+        for f, (a, b, t) in enumerate(zip(i.tolist(), j.tolist(), u.tolist())):
+            q1, q2 = self.rotations[a], self.rotations[b]
+            if q1.w * q2.w + q1.x * q2.x + q1.y * q2.y + q1.z * q2.z > math.cos(0.01):
+                # new_interpolate snaps to q2 this close; blend linearly
+                # instead, which is as good at such small angles
+                r = euclid.Quaternion(q1.w + (q2.w - q1.w) * t, q1.x + (q2.x - q1.x) * t,
+                                      q1.y + (q2.y - q1.y) * t, q1.z + (q2.z - q1.z) * t).normalized()
+            else:
+                r = euclid.Quaternion.new_interpolate(q1, q2, t)
+            q[f] = (r.w, r.x, r.y, r.z)
+        return q
+
+    # Camera-to-world transforms of the frames at times, as an (F, 4, 4)
+    # array: rotation in the upper left 3x3, translation in the last column.
+    def matrices(self, times):
+        i, j, u = self._segments(np.atleast_1d(times))
+        m = np.zeros((len(u), 4, 4))
+        m[:, :3, :3] = quaternionMatrices(self._quaternions(i, j, u))
+        m[:, :3, 3] = self._translations(i, j, u)
+        m[:, 3, 3] = 1.0
+        return m
+
+    # Cameras of the frames at times, one per time.
+    def cameras(self, times):
+        m = self.matrices(times)
+        rotation, translation = m[:, :3, :3], m[:, :3, 3]
+        points = np.einsum('fij,pj->fpi', rotation, self.points) + translation[:, np.newaxis, :]
+        vectors = np.einsum('fij,vj->fvi', rotation, self.vectors)
+        for p, v in zip(points.tolist(), vectors.tolist()):
+            camera = copy.copy(self.camera)
+            for name, value in zip(_POINTS, p):
+                setattr(camera, name, P3(*value))
+            for name, value in zip(_VECTORS, v):
+                setattr(camera, name, V3(*value))
+            yield camera
@@ -0,0 +1,113 @@
+import numpy as np
+from shapes import RaycastingSphere
+from packets import spheresInCone
+from bvh import BVH, LEAF_SIZE
+
+# Shadow-caster lists. Whether one object can shadow another from a light
+# only depends on where the three are: a shadow ray towards the light from
+# a sphere stays inside the cone from the light around that sphere (and,
+# for Scene.light's rays, which go on past it, the mirrored cone beyond).
+# Worked out once for every object and light, the lists spare the shadow
+# test all other objects for as long as neither objects nor lights move,
+# e.g. for every frame of a camera flythrough.
+# The cones are walked down a bvh.BVH over the spheres, so each receiver
+# only looks at the boxes its cone reaches instead of at every sphere.
+
+# Receivers whose cones are walked down the tree together.
+RECEIVERS_PER_PASS = 4096
+
+class ShadowCasters(object):
+    # lights: (position, beyond) pairs, beyond being whether the shadow rays
+    # go on past the light.
+    def __init__(self, objects, lights):
+        self.objects = list(objects)
+        spheres = [o for o in self.objects if type(o) == RaycastingSphere]
+        # everything else is unbounded and may shadow anything
+        others = [o for o in self.objects if type(o) != RaycastingSphere]
+        centres = np.array([tuple(o.c) for o in spheres], dtype=np.float64).reshape(-1, 3)
+        radii = np.array([o.r for o in spheres], dtype=np.float64)
+        # objects of spheres by their place in self.objects, to keep the
+        # scene's order in the lists
+        order = dict((id(o), i) for i, o in enumerate(self.objects))
+        tree = _ConeTree(spheres)
+        self._lists = {}
+        for position, beyond in lights:
+            light = np.array(tuple(position), dtype=np.float64)
+            toReceivers = centres - light
+            d = np.sqrt((toReceivers * toReceivers).sum(axis=1))
+            # the light inside a receiver: rays leave in every direction
+            outside = np.flatnonzero(d > radii)
+            lists = {}
+            for start in xrange(0, len(outside), RECEIVERS_PER_PASS):
+                receivers = outside[start:start + RECEIVERS_PER_PASS]
+                dr = d[receivers]
+                receiver, caster = tree.inCones(centres, radii, light,
+                                                toReceivers[receivers] / dr[:, np.newaxis],
+                                                np.arcsin(radii[receivers] / dr),
+                                                dr + radii[receivers], beyond)
+                ends = np.cumsum(np.bincount(receiver, minlength=len(receivers))).tolist()
+                caster = caster.tolist()
+                for k, i in enumerate(receivers.tolist()):
+                    casters = [spheres[j] for j in caster[(ends[k - 1] if k else 0):ends[k]]] + others
+                    casters.sort(key=lambda o: order[id(o)])
+                    lists[spheres[i].objectId] = casters
+            self._lists[tuple(position)] = lists
+
+    # The objects that may shadow obj from the light at position light (a
+    # tuple), in scene order.
+    def casters(self, obj, light):
+        lists = self._lists.get(light)
+        if lists is None:
+            return self.objects
+        return lists.get(obj.objectId, self.objects)
+
+# bvh.BVH over spheres as arrays, each node's box bounded by a sphere, for
+# walking many cones down it at once.
+class _ConeTree(object):
+    def __init__(self, spheres):
+        tree = BVH(spheres)
+        n = len(tree.lo)
+        lo = np.array(tree.lo, dtype=np.float64).reshape(-1, 3)
+        hi = np.array(tree.hi, dtype=np.float64).reshape(-1, 3)
+        self.centres = (lo + hi) / 2
+        # a little larger, so that rounding can't drop a sphere touching
+        # the box's corner
+        self.radii = np.sqrt(((hi - lo) ** 2).sum(axis=1)) / 2 * (1 + 1e-9)
+        self.left = np.array(tree.left, dtype=np.intp)
+        self.right = np.array(tree.right, dtype=np.intp)
+        # sphere indices of every leaf's objects, -1 padded
+        index = dict((id(o), i) for i, o in enumerate(spheres))
+        self.members = np.full((n, LEAF_SIZE), -1, dtype=np.intp)
+        for node, leaf in enumerate(tree.leaves):
+            if leaf is not None:
+                self.members[node, :len(leaf)] = [index[id(o)] for o in leaf]
+
+    # (cone, sphere) index pairs of the spheres ((S, 3) centres, (S,) radii,
+    # those the tree was built over) reaching into each of the cones around
+    # apex given by axes ((K, 3)), spreads and lengths ((K,)), like
+    # packets.spheresInCone; ordered by cone, then sphere.
+    def inCones(self, centres, radii, apex, axes, spreads, lengths, beyond):
+        empty = np.zeros(0, dtype=np.intp)
+        if not len(self.left) or not len(axes):
+            return empty, empty
+        cone = np.arange(len(axes))
+        node = np.zeros(len(axes), dtype=np.intp)
+        found = []
+        while len(cone):
+            reach = spheresInCone(self.centres[node], self.radii[node], apex, axes[cone],
+                                  spreads[cone], lengths[cone], beyond)
+            cone, node = cone[reach], node[reach]
+            leaf = self.left[node] < 0
+            members = self.members[node[leaf]]
+            taken = members >= 0
+            found.append((np.repeat(cone[leaf], LEAF_SIZE).reshape(-1, LEAF_SIZE)[taken], members[taken]))
+            cone, node = cone[~leaf], node[~leaf]
+            cone = np.concatenate((cone, cone))
+            node = np.concatenate((self.left[node], self.right[node]))
+        cone = np.concatenate([c for c, s in found])
+        sphere = np.concatenate([s for c, s in found])
+        near = spheresInCone(centres[sphere], radii[sphere], apex, axes[cone], spreads[cone],
+                             lengths[cone], beyond)
+        cone, sphere = cone[near], sphere[near]
+        order = np.lexsort((sphere, cone))
+        return cone[order], sphere[order]
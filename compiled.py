@@ -0,0 +1,118 @@
+import numpy as np
+from shapes import RaycastingSphere, RaycastingPlane
+from batch import intersectSpheres, intersectPlanes
+
+# Structure-of-arrays form of a scene's objects, built by Scene.compile().
+# Every object has an index: its position in the objects list it was built
+# from. Per-object arrays are indexed by it:
+#   kinds       (N,) int8, SPHERE, PLANE or OTHER
+#   colors      (N, 2, 3) uint8, a sphere's color twice, a plane's two
+#               checker colors (color1, color2)
+#   reflection  (N,) float64, reflectionIndex
+# Per-shape arrays hold the geometry; sphereIndex/planeIndex map their rows
+# back to object indices, objectRow maps an object index to its row in the
+# arrays of its kind:
+#   centres (S, 3), radii (S,)
+#   normals (P, 3), offsets (P,), axes (P, 2, 3) basicX/basicY,
+#   squareSizes (P,)
+# Objects of any other type are listed in others and still tested one by
+# one by the caller.
+
+SPHERE = 0
+PLANE = 1
+OTHER = -1
+
+# Scenes with fewer objects than this are quicker for Scene's recursive path
+# to test one object at a time than with a kernel call per ray.
+MIN_OBJECTS = 32
+
+class CompiledScene(object):
+    def __init__(self, objects):
+        self.objects = objects
+        n = len(objects)
+        self.kinds = np.full(n, OTHER, dtype=np.int8)
+        self.colors = np.zeros((n, 2, 3), dtype=np.uint8)
+        self.reflection = np.zeros(n, dtype=np.float64)
+        self.objectRow = np.full(n, -1, dtype=np.intp)
+        spheres, planes, self.others = [], [], []
+        for i, o in enumerate(objects):
+            self.reflection[i] = o.reflectionIndex
+            if type(o) == RaycastingSphere:
+                self.kinds[i] = SPHERE
+                self.colors[i] = (o.color, o.color)
+                self.objectRow[i] = len(spheres)
+                spheres.append(i)
+            elif type(o) == RaycastingPlane:
+                self.kinds[i] = PLANE
+                self.colors[i] = (o.color1, o.color2)
+                self.objectRow[i] = len(planes)
+                planes.append(i)
+            else:
+                self.others.append(o)
+        self.sphereIndex = np.array(spheres, dtype=np.intp)
+        self.planeIndex = np.array(planes, dtype=np.intp)
+        self.centres = np.array([tuple(objects[i].c) for i in spheres], dtype=np.float64).reshape(-1, 3)
+        self.radii = np.array([objects[i].r for i in spheres], dtype=np.float64)
+        self.normals = np.array([tuple(objects[i].shape.n) for i in planes], dtype=np.float64).reshape(-1, 3)
+        self.offsets = np.array([objects[i].shape.k for i in planes], dtype=np.float64)
+        self.axes = np.array([(tuple(objects[i].basicX), tuple(objects[i].basicY)) for i in planes],
+                             dtype=np.float64).reshape(-1, 2, 3)
+        self.squareSizes = np.array([objects[i].squaresize for i in planes], dtype=np.float64)
+        self._index = dict((id(o), i) for i, o in enumerate(objects))
+
+    # _index is keyed on id(), which doesn't survive pickling.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = dict((id(o), i) for i, o in enumerate(self.objects))
+
+    def __len__(self):
+        return len(self.kinds)
+
+    # index of obj, or -1 if it wasn't compiled
+    def indexOf(self, obj):
+        return self._index.get(id(obj), -1)
+
+    # Bytes taken by the packed arrays.
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.kinds, self.colors, self.reflection, self.objectRow,
+                                      self.sphereIndex, self.planeIndex, self.centres, self.radii,
+                                      self.normals, self.offsets, self.axes, self.squareSizes))
+
+    # Nearest hit of every ray with the packed spheres and planes.
+    # origins, directions: (N, 3). exclude: optional (N,) object index each
+    # ray left from, or -1. spheres: optional sphere rows to test instead of
+    # all of them, in increasing order. Returns (t, index): ray parameter of
+    # the nearest hit (inf on a miss) and the object index hit (-1 on a
+    # miss).
+    def intersect(self, origins, directions, exclude=None, spheres=None):
+        sphereExclude = planeExclude = None
+        if exclude is not None and len(self.kinds):
+            exclude = np.asarray(exclude, dtype=np.intp).reshape(-1)
+            rows = np.where(exclude >= 0, self.objectRow[exclude], -1)
+            kinds = np.where(exclude >= 0, self.kinds[exclude], OTHER)
+            sphereExclude = np.where(kinds == SPHERE, rows, -1)
+            planeExclude = np.where(kinds == PLANE, rows, -1)
+        if spheres is None:
+            t, rows = intersectSpheres(origins, directions, self.centres, self.radii, sphereExclude)
+        else:
+            if sphereExclude is not None:
+                # renumber to positions in spheres
+                position = np.full(len(self.radii) + 1, -1, dtype=np.intp)
+                position[spheres] = np.arange(len(spheres))
+                sphereExclude = position[sphereExclude]
+            t, rows = intersectSpheres(origins, directions, self.centres[spheres], self.radii[spheres],
+                                       sphereExclude)
+            rows[rows >= 0] = spheres[rows[rows >= 0]]
+        index = np.full(len(t), -1, dtype=np.intp)
+        hit = rows >= 0
+        index[hit] = self.sphereIndex[rows[hit]]
+        planeT, planeRows = intersectPlanes(origins, directions, self.normals, self.offsets, planeExclude)
+        closer = planeT < t
+        t = np.where(closer, planeT, t)
+        index[closer] = self.planeIndex[planeRows[closer]]
+        return t, index
@@ -40,6 +40,12 @@ try:
 except NameError:
     long = int
 
+# Only the batch types (Vector3Array, Point3Array) need numpy.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Some magic here.  If _use_slots is True, the classes will derive from
 # object and will define a __slots__ class variable.  If _use_slots is
 # False, classes will be old-style and will not define __slots__.
@@ -397,6 +403,8 @@ class Vector3:
             return _class(self.x + other.x,
                           self.y + other.y,
                           self.z + other.z)
+        elif isinstance(other, Vector3Array):
+            return NotImplemented
         else:
             assert hasattr(other, '__len__') and len(other) == 3
             return Vector3(self.x + other[0],
@@ -427,6 +435,8 @@ class Vector3:
             return Vector3(self.x - other.x,
                            self.y - other.y,
                            self.z - other.z)
+        elif isinstance(other, Vector3Array):
+            return NotImplemented
         else:
             assert hasattr(other, '__len__') and len(other) == 3
             return Vector3(self.x - other[0],
@@ -455,6 +465,8 @@ class Vector3:
             return _class(self.x * other.x,
                           self.y * other.y,
                           self.z * other.z)
+        elif isinstance(other, Vector3Array):
+            return NotImplemented
         else: 
             assert type(other) in (int, long, float)
             return Vector3(self.x * other,
@@ -591,6 +603,22 @@ class Vector3:
         n = other.normalized()
         return self.dot(n)*n
 
+    def frozen(self):
+        """Return an immutable, hashable copy"""
+        if isinstance(self, Point3):
+            return FrozenPoint3(self.x, self.y, self.z)
+        return FrozenVector3(self.x, self.y, self.z)
+
+    def thawed(self):
+        """Return a mutable copy"""
+        return _kind3(self)(self.x, self.y, self.z)
+
+# Vector3 or Point3, whichever v behaves as; frozen variants included.
+def _kind3(v):
+    if isinstance(v, Point3):
+        return Point3
+    return Vector3
+
 # a b c 
 # e f g 
 # i j k 
@@ -2089,6 +2117,32 @@ def _intersect_point3_sphere(P, S):
     return abs(P - S.c) <= S.r
     
 def _intersect_line3_sphere(L, S):
+    span = intersect_line3_sphere_span(L, S)
+    if span is None:
+        return None
+    u2, u1 = span
+    return LineSegment3(Point3(L.p.x + u1 * L.v.x,
+                               L.p.y + u1 * L.v.y,
+                               L.p.z + u1 * L.v.z),
+                        Point3(L.p.x + u2 * L.v.x,
+                               L.p.y + u2 * L.v.y,
+                               L.p.z + u2 * L.v.z))
+
+def _intersect_line3_plane(L, P):
+    u = intersect_line3_plane_t(L, P)
+    if u is None:
+        return None
+    return Point3(L.p.x + u * L.v.x,
+                  L.p.y + u * L.v.y,
+                  L.p.z + u * L.v.z)
+
+# Parametric intersections.  These take the shapes directly, skipping the
+# intersect() double dispatch, and return the parameter t of the
+# intersection along the line (the point being L.p + t * L.v) as plain
+# floats instead of building Point3/LineSegment3 objects.
+
+def intersect_line3_sphere_span(L, S):
+    """Return (t_near, t_far) of the part of L inside S, or None"""
     a = L.v.magnitude_squared()
     b = 2 * (L.v.x * (L.p.x - S.c.x) + \
              L.v.y * (L.p.y - S.c.y) + \
@@ -2109,14 +2163,17 @@ def _intersect_line3_sphere(L, S):
         u2 = max(u2, 0.0)
     if u1 < u2:
         return None
-    return LineSegment3(Point3(L.p.x + u1 * L.v.x,
-                               L.p.y + u1 * L.v.y,
-                               L.p.z + u1 * L.v.z),
-                        Point3(L.p.x + u2 * L.v.x,
-                               L.p.y + u2 * L.v.y,
-                               L.p.z + u2 * L.v.z))
+    return u2, u1
 
-def _intersect_line3_plane(L, P):
+def intersect_line3_sphere_t(L, S):
+    """Return t of the first point of L inside S, or None"""
+    span = intersect_line3_sphere_span(L, S)
+    if span is None:
+        return None
+    return span[0]
+
+def intersect_line3_plane_t(L, P):
+    """Return t of the intersection of L and P, or None"""
     d = P.n.dot(L.v)
     if not d:
         # Parallel
@@ -2124,9 +2181,7 @@ def _intersect_line3_plane(L, P):
     u = (P.k - P.n.dot(L.p)) / d
     if not L._u_in(u):
         return None
-    return Point3(L.p.x + u * L.v.x,
-                  L.p.y + u * L.v.y,
-                  L.p.z + u * L.v.z)
+    return u
 
 def _intersect_plane_plane(A, B):
     n1_m = A.n.magnitude_squared()
@@ -2263,6 +2318,10 @@ class Ray3(Line3):
     def _u_in(self, u):
         return u >= 0.0
 
+    def frozen(self):
+        """Return an immutable, hashable copy"""
+        return FrozenRay3(self.p, self.v)
+
 class LineSegment3(Line3):
     def __repr__(self):
         return 'LineSegment3(<%.2f, %.2f, %.2f> to <%.2f, %.2f, %.2f>)' % \
@@ -2299,6 +2358,10 @@ class Sphere:
 
     copy = __copy__
 
+    def frozen(self):
+        """Return an immutable, hashable copy"""
+        return FrozenSphere(self.c, self.r)
+
     def __repr__(self):
         return 'Sphere(<%.2f, %.2f, %.2f>, radius=%.2f)' % \
             (self.c.x, self.c.y, self.c.z, self.r)
@@ -2367,6 +2430,10 @@ class Plane:
 
     copy = __copy__
 
+    def frozen(self):
+        """Return an immutable, hashable copy"""
+        return _new_plane(FrozenPlane, self.n.frozen(), self.k)
+
     def __repr__(self):
         return 'Plane(<%.2f, %.2f, %.2f>.p = %.2f)' % \
             (self.n.x, self.n.y, self.n.z, self.k)
@@ -2408,3 +2475,367 @@ class Plane:
 
     def _connect_plane(self, other):
         return _connect_plane_plane(other, self)
+
+# Immutable geometry
+# ---------------------------------------------------------------------------
+# Frozen variants are hashable and compare equal to the mutable objects with
+# the same values; frozen vectors and points also hash like the tuples of
+# their components. Arithmetic on them works as on the mutable types and
+# returns mutable results; frozen() and thawed() convert between the two.
+
+def _frozen_setattr(self, name, value):
+    raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+class FrozenVector3(Vector3):
+    def __init__(self, x=0, y=0, z=0):
+        object.__setattr__(self, 'x', x)
+        object.__setattr__(self, 'y', y)
+        object.__setattr__(self, 'z', z)
+
+    __setattr__ = _frozen_setattr
+
+    def __setitem__(self, key, value):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    def __reduce__(self):
+        return (self.__class__, (self.x, self.y, self.z))
+
+    def __hash__(self):
+        return hash((self.x, self.y, self.z))
+
+    def __repr__(self):
+        return '%s(%.2f, %.2f, %.2f)' % (self.__class__.__name__,
+                                         self.x, self.y, self.z)
+
+    # in-place operators rebind to a new, mutable object like they do for
+    # tuples
+    def __iadd__(self, other):
+        return self + other
+
+    def __imul__(self, other):
+        return self * other
+
+    # Vector3 tells vectors from points by exact class; frozen operands
+    # count as what they thaw to. These also come first when a frozen
+    # operand is on the right of a mutable one it subclasses. Differences
+    # are Vector3 whatever the operands.
+    def __add__(self, other):
+        if isinstance(other, Vector3):
+            if _kind3(self) is _kind3(other):
+                _class = Vector3
+            else:
+                _class = Point3
+            return _class(self.x + other.x,
+                          self.y + other.y,
+                          self.z + other.z)
+        return Vector3.__add__(self, other)
+    __radd__ = __add__
+
+    def __mul__(self, other):
+        if isinstance(other, Vector3):
+            if isinstance(self, Point3) or isinstance(other, Point3):
+                _class = Point3
+            else:
+                _class = Vector3
+            return _class(self.x * other.x,
+                          self.y * other.y,
+                          self.z * other.z)
+        return Vector3.__mul__(self, other)
+    __rmul__ = __mul__
+
+    def frozen(self):
+        return self
+
+    def thawed(self):
+        """Return a mutable copy"""
+        return _kind3(self)(self.x, self.y, self.z)
+
+class FrozenPoint3(FrozenVector3, Point3):
+    pass
+
+class FrozenRay3(Ray3):
+    def __init__(self, *args):
+        ray = Ray3(*args)
+        object.__setattr__(self, 'p', ray.p.frozen())
+        object.__setattr__(self, 'v', ray.v.frozen())
+
+    __setattr__ = _frozen_setattr
+
+    def __reduce__(self):
+        return (self.__class__, (self.p, self.v))
+
+    def __eq__(self, other):
+        return isinstance(other, Ray3) and \
+               self.p == other.p and self.v == other.v
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.p, self.v))
+
+    def frozen(self):
+        return self
+
+    def thawed(self):
+        """Return a mutable copy"""
+        return Ray3(self.p.thawed(), self.v.thawed())
+
+class FrozenSphere(Sphere):
+    def __init__(self, center, radius):
+        assert isinstance(center, Vector3) and type(radius) == float
+        object.__setattr__(self, 'c', center.frozen())
+        object.__setattr__(self, 'r', radius)
+
+    __setattr__ = _frozen_setattr
+
+    def __reduce__(self):
+        return (self.__class__, (self.c, self.r))
+
+    def __eq__(self, other):
+        return isinstance(other, Sphere) and \
+               self.c == other.c and self.r == other.r
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.c, self.r))
+
+    def frozen(self):
+        return self
+
+    def thawed(self):
+        """Return a mutable copy"""
+        return Sphere(self.c.thawed(), self.r)
+
+class FrozenPlane(Plane):
+    def __init__(self, *args):
+        plane = Plane(*args)
+        object.__setattr__(self, 'n', plane.n.frozen())
+        object.__setattr__(self, 'k', plane.k)
+
+    __setattr__ = _frozen_setattr
+
+    def __reduce__(self):
+        return (_new_plane, (FrozenPlane, self.n, self.k))
+
+    def __eq__(self, other):
+        return isinstance(other, Plane) and \
+               self.n == other.n and self.k == other.k
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.n, self.k))
+
+    def frozen(self):
+        return self
+
+    def thawed(self):
+        """Return a mutable copy"""
+        return _new_plane(Plane, self.n.thawed(), self.k)
+
+# A plane of class cls with n and k as they are; the constructors would
+# normalize n again, which can change it in the last bit.
+def _new_plane(cls, n, k):
+    plane = cls.__new__(cls)
+    object.__setattr__(plane, 'n', n)
+    object.__setattr__(plane, 'k', k)
+    return plane
+
+# Batch types
+# ---------------------------------------------------------------------------
+# Vector3Array and Point3Array hold N vectors or points in an (N, 3) numpy
+# array, data, and do what Vector3 and Point3 do on all of them at once.
+# Operands can be other arrays of the same length, single Vector3s or Point3s
+# (applied to every element), or anything numpy broadcasts against data.
+# Single vectors and points may be on either side: Vector3 arithmetic
+# leaves array operands to the array's reflected methods.
+# Results follow the Vector3/Point3 rules for which kind they are, and each
+# element is computed with the same arithmetic as the scalar method.
+
+# The (N, 3) or (3,) float array other stands for.
+def _array3(other):
+    if isinstance(other, Vector3Array):
+        return other.data
+    if isinstance(other, Vector3):
+        return numpy.array((other.x, other.y, other.z), dtype=numpy.float64)
+    other = numpy.asarray(other, dtype=numpy.float64)
+    assert other.shape[-1:] == (3,)
+    return other
+
+# Whether other is one or many points.
+def _is_points(other):
+    return isinstance(other, (Point3, Point3Array))
+
+# Per-element factor: a number or an (N,) array.
+def _factor(other):
+    assert not isinstance(other, (Vector3, Vector3Array))
+    other = numpy.asarray(other, dtype=numpy.float64)
+    if other.ndim == 1:
+        return other[:, numpy.newaxis]
+    assert other.ndim == 0
+    return other
+
+class Vector3Array:
+    __slots__ = ['data']
+    __hash__ = None
+    # so that numpy arrays on the left leave operators to us
+    __array_priority__ = 100
+
+    def __init__(self, data=()):
+        if numpy is None:
+            raise ImportError('%s needs numpy' % self.__class__.__name__)
+        if len(data) and isinstance(data[0], Vector3):
+            data = [(v.x, v.y, v.z) for v in data]
+        self.data = numpy.array(data, dtype=numpy.float64).reshape(-1, 3)
+
+    # the scalar type of the elements
+    element = Vector3
+
+    @classmethod
+    def _new(cls, data):
+        a = cls.__new__(cls)
+        a.data = data
+        return a
+
+    def __copy__(self):
+        return self._new(self.data.copy())
+
+    copy = __copy__
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, len(self.data))
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector3Array):
+            return False
+        return numpy.array_equal(self.data, other.data)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        """An element for an integer key, an array for a slice or mask"""
+        if isinstance(key, (int, long, numpy.integer)):
+            return self.element(*self.data[key].tolist())
+        return self._new(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = _array3(value)
+
+    def __iter__(self):
+        element = self.element
+        return (element(*v) for v in self.data.tolist())
+
+    x = property(lambda self: self.data[:, 0])
+    y = property(lambda self: self.data[:, 1])
+    z = property(lambda self: self.data[:, 2])
+
+    def __add__(self, other):
+        # same kinds -> Vector, mixed -> Point, as Vector3.__add__
+        if isinstance(other, (Vector3, Vector3Array)) and \
+           _is_points(self) != _is_points(other):
+            _class = Point3Array
+        else:
+            _class = Vector3Array
+        return _class._new(self.data + _array3(other))
+    __radd__ = __add__
+
+    def __iadd__(self, other):
+        self.data += _array3(other)
+        return self
+
+    def __sub__(self, other):
+        return Vector3Array._new(self.data - _array3(other))
+
+    def __rsub__(self, other):
+        return Vector3Array._new(_array3(other) - self.data)
+
+    def __isub__(self, other):
+        self.data -= _array3(other)
+        return self
+
+    def __mul__(self, other):
+        if isinstance(other, (Vector3, Vector3Array)):
+            # component-wise
+            if _is_points(self) or _is_points(other):
+                _class = Point3Array
+            else:
+                _class = Vector3Array
+            return _class._new(self.data * _array3(other))
+        return Vector3Array._new(self.data * _factor(other))
+
+    __rmul__ = __mul__
+
+    def __imul__(self, other):
+        self.data *= _factor(other)
+        return self
+
+    def __truediv__(self, other):
+        return Vector3Array._new(self.data / _factor(other))
+
+    __div__ = __truediv__
+
+    def __neg__(self):
+        return Vector3Array._new(-self.data)
+
+    __pos__ = __copy__
+
+    def __abs__(self):
+        """(N,) array of the magnitudes"""
+        d = self.data
+        return numpy.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2 + d[:, 2] ** 2)
+
+    magnitude = __abs__
+
+    def magnitude_squared(self):
+        """(N,) array of the squared magnitudes"""
+        d = self.data
+        return d[:, 0] ** 2 + d[:, 1] ** 2 + d[:, 2] ** 2
+
+    def normalize(self):
+        d = self.magnitude()
+        nonzero = d != 0
+        self.data[nonzero] /= d[nonzero][:, numpy.newaxis]
+        return self
+
+    def normalized(self):
+        """Unit vectors; zero vectors stay zero"""
+        d = self.magnitude()
+        nonzero = (d != 0)[:, numpy.newaxis]
+        data = numpy.where(nonzero, self.data / numpy.where(nonzero, d[:, numpy.newaxis], 1.0),
+                           self.data)
+        return Vector3Array._new(data)
+
+    def dot(self, other):
+        """(N,) array of the dot products"""
+        assert isinstance(other, (Vector3, Vector3Array))
+        a, b = self.data, _array3(other)
+        return a[..., 0] * b[..., 0] + \
+               a[..., 1] * b[..., 1] + \
+               a[..., 2] * b[..., 2]
+
+    def cross(self, other):
+        assert isinstance(other, (Vector3, Vector3Array))
+        a, b = self.data, _array3(other)
+        data = numpy.empty(numpy.broadcast(a, b).shape)
+        data[:, 0] = a[:, 1] * b[..., 2] - a[:, 2] * b[..., 1]
+        data[:, 1] = -a[:, 0] * b[..., 2] + a[:, 2] * b[..., 0]
+        data[:, 2] = a[:, 0] * b[..., 1] - a[:, 1] * b[..., 0]
+        return Vector3Array._new(data)
+
+    def reflect(self, normal):
+        # assume normals are normalized
+        assert isinstance(normal, (Vector3, Vector3Array))
+        n = _array3(normal)
+        d = 2 * self.dot(normal)[:, numpy.newaxis]
+        return Vector3Array._new(self.data - d * n)
+
+class Point3Array(Vector3Array):
+    element = Point3
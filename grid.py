@@ -0,0 +1,142 @@
+import math
+import numpy as np
+from shapes import RaycastingSphere
+
+# Uniform grid over the spheres of a scene, for dense clouds of similarly
+# sized spheres where it beats the BVH.
+# Space around the spheres is cut into equal cubic cells; each cell lists
+# the spheres whose bounding boxes overlap it. Rays walk through the cells
+# they cross in order (3D-DDA) and only test the spheres listed there, each
+# at most once. Like bvh.BVH it takes planes and other unbounded objects out
+# into self.others and leaves the ray/object tests to a callback.
+
+# Cells per sphere the cell size is chosen for.
+CELLS_PER_OBJECT = 2.0
+# Cells along any one axis at most.
+MAX_RESOLUTION = 256
+# Boxes are registered this much larger, so that a hit on a cell's border is
+# found in both cells.
+PADDING = 1e-9
+
+class Grid(object):
+    def __init__(self, objects, cellsPerObject=CELLS_PER_OBJECT):
+        self.objects = [o for o in objects if type(o) == RaycastingSphere]
+        self.others = [o for o in objects if type(o) != RaycastingSphere]
+        self.cells = []
+        if not self.objects:
+            return
+        centres = np.array([tuple(o.c) for o in self.objects], dtype=np.float64)
+        radii = np.array([o.r for o in self.objects], dtype=np.float64)[:, np.newaxis]
+        lo = centres - radii
+        hi = centres + radii
+        self.lo = lo.min(axis=0)
+        extent = hi.max(axis=0) - self.lo
+        # cell size from the density of the spheres, but no smaller than
+        # they are, or each would have to be listed in many cells
+        size = (extent.prod() / (cellsPerObject * len(self.objects))) ** (1.0 / 3)
+        size = max(size, radii.mean(), (extent / MAX_RESOLUTION).max())
+        self.size = float(size)
+        self.resolution = tuple(int(r) for r in np.maximum(np.ceil(extent / size), 1).tolist())
+        self.hi = self.lo + np.array(self.resolution) * self.size
+        self.cells = [None] * (self.resolution[0] * self.resolution[1] * self.resolution[2])
+        first = self._clamp(np.floor((lo - PADDING - self.lo) / self.size).astype(int))
+        last = self._clamp(np.floor((hi + PADDING - self.lo) / self.size).astype(int))
+        ny, nz = self.resolution[1], self.resolution[2]
+        for o, (x0, y0, z0), (x1, y1, z1) in zip(self.objects, first.tolist(), last.tolist()):
+            for x in xrange(x0, x1 + 1):
+                for y in xrange(y0, y1 + 1):
+                    for z in xrange(z0, z1 + 1):
+                        cell = (x * ny + y) * nz + z
+                        if self.cells[cell] is None:
+                            self.cells[cell] = []
+                        self.cells[cell].append(o)
+        self.lo = tuple(self.lo.tolist())
+        self.hi = tuple(self.hi.tolist())
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _clamp(self, cells):
+        return np.clip(cells, 0, np.array(self.resolution) - 1)
+
+    # Cells ray passes through, nearest first, as (objects, tExit): the
+    # spheres in the cell not yet seen in an earlier one, and the ray
+    # parameter where the ray leaves the cell.
+    def _walk(self, ray):
+        p, v = tuple(ray.p), tuple(ray.v)
+        # where the ray enters the grid, slab test as in BVH._enter
+        tEnter, tLeave = 0.0, float('inf')
+        for axis in xrange(3):
+            if v[axis] == 0:
+                if p[axis] < self.lo[axis] or p[axis] > self.hi[axis]:
+                    return
+                continue
+            t1 = (self.lo[axis] - p[axis]) / v[axis]
+            t2 = (self.hi[axis] - p[axis]) / v[axis]
+            if t1 > t2:
+                t1, t2 = t2, t1
+            tEnter = max(tEnter, t1)
+            tLeave = min(tLeave, t2)
+            if tEnter > tLeave:
+                return
+        cell, step, tMax, tDelta = [], [], [], []
+        for axis in xrange(3):
+            n = self.resolution[axis]
+            i = int(math.floor((p[axis] + v[axis] * tEnter - self.lo[axis]) / self.size))
+            i = min(max(i, 0), n - 1)
+            cell.append(i)
+            if v[axis] > 0:
+                step.append(1)
+                tMax.append((self.lo[axis] + (i + 1) * self.size - p[axis]) / v[axis])
+                tDelta.append(self.size / v[axis])
+            elif v[axis] < 0:
+                step.append(-1)
+                tMax.append((self.lo[axis] + i * self.size - p[axis]) / v[axis])
+                tDelta.append(-self.size / v[axis])
+            else:
+                step.append(0)
+                tMax.append(float('inf'))
+                tDelta.append(0.0)
+        ny, nz = self.resolution[1], self.resolution[2]
+        seen = set()
+        while True:
+            axis = tMax.index(min(tMax))
+            objects = self.cells[(cell[0] * ny + cell[1]) * nz + cell[2]]
+            if objects is not None:
+                fresh = [o for o in objects if id(o) not in seen]
+                seen.update(id(o) for o in fresh)
+                if fresh:
+                    yield fresh, tMax[axis]
+            cell[axis] += step[axis]
+            if not 0 <= cell[axis] < self.resolution[axis]:
+                return
+            tMax[axis] += tDelta[axis]
+
+    # Closest hit, with the same interface as BVH.nearest. A hit inside the
+    # cell being walked through can't be beaten by anything in the cells
+    # after it, so the walk stops there.
+    def nearest(self, ray, maxT, test, *args):
+        best = (maxT, None)
+        if not self.objects:
+            return best
+        tCell = 0.0
+        for objects, tExit in self._walk(ray):
+            if tCell > best[0]:
+                break
+            hit = test(objects, ray, *args)
+            if hit[1] is not None and hit[0] < best[0]:
+                best = hit
+            if best[1] is not None and best[0] <= tExit:
+                break
+            tCell = tExit
+        return best
+
+    # Any hit, with the same interface as BVH.anyHit.
+    def anyHit(self, ray, test, *args):
+        if not self.objects:
+            return None
+        for objects, tExit in self._walk(ray):
+            blocker = test(objects, ray, *args)
+            if blocker is not None:
+                return blocker
+        return None
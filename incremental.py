@@ -0,0 +1,244 @@
+import cPickle as pickle
+import numpy as np
+from PIL import Image
+from shapes import RaycastingSphere, pickleContent
+from stats import RenderStats
+from raytrace import findEdges, toPixels
+
+# Frame-to-frame re-rendering of scenes in which only a few objects change.
+# While a frame is traced, a RayLog records every ray of every pixel: where
+# it started, its direction and how far along it the result was decided
+# (its hit, or the whole ray for misses and shadow rays), as well as the
+# objects the rays hit or were blocked by. When objects change, a pixel
+# whose rays neither touched a changed object nor pass through its old or
+# new bounds would trace exactly as before, so only the other pixels are
+# traced again.
+
+# Every ray traced while a RayLog is a Scene's rayLog, as rows of
+# (pixel, origin xyz, direction xyz, tMax), and (pixel, object id) for every
+# object a ray hit or was blocked by. Object ids are id()s.
+class RayLog(object):
+    def __init__(self):
+        # frame pixel of the ray being traced by the recursive path
+        self.pixel = -1
+        # frame pixel of each ray of the batch given to Scene.tracePrimary
+        self.pixels = None
+        self._rays = []
+        self._touched = []
+        self._chunks = []
+        self._touchedChunks = []
+        self._objectIds = (None, None)
+
+    def addRay(self, ray, t, obj):
+        self._rays.append((self.pixel, ray.p.x, ray.p.y, ray.p.z, ray.v.x, ray.v.y, ray.v.z, t))
+        if obj is not None:
+            self.touch(obj)
+
+    def touch(self, obj):
+        self._touched.append((self.pixel, id(obj)))
+
+    # Batch form of addRay; ids are object ids, -1 for none.
+    def addRays(self, pixels, origins, directions, t, ids):
+        rays = np.empty((len(pixels), 8))
+        rays[:, 0] = pixels
+        rays[:, 1:4] = origins
+        rays[:, 4:7] = directions
+        rays[:, 7] = t
+        self._chunks.append(rays)
+        hit = ids != -1
+        self._touchedChunks.append(np.column_stack((pixels[hit], ids[hit])).astype(np.int64))
+
+    # id of every object of compiled by index, with -1 appended so that
+    # indexing with -1 gives -1.
+    def objectIds(self, compiled):
+        if self._objectIds[0] is not compiled:
+            ids = np.array([id(o) for o in compiled.objects] + [-1], dtype=np.int64)
+            self._objectIds = (compiled, ids)
+        return self._objectIds[1]
+
+    # All logged rays as an (M, 8) float array and touched objects as a
+    # (K, 2) int64 array.
+    def arrays(self):
+        rays = self._chunks + [np.array(self._rays, dtype=np.float64).reshape(-1, 8)]
+        touched = self._touchedChunks + [np.array(self._touched, dtype=np.int64).reshape(-1, 2)]
+        return np.concatenate(rays), np.concatenate(touched)
+
+# (centre, radius) of a sphere around obj, or None if it has no bounds.
+def boundsOf(obj):
+    if type(obj) == RaycastingSphere:
+        return tuple(obj.c), obj.r
+    return None
+
+# Which rays (rows of RayLog.arrays()) pass through the sphere before their
+# tMax. Rays that only graze it count as passing through.
+def raysThroughSphere(rays, centre, radius):
+    o = rays[:, 1:4] - np.array(centre, dtype=np.float64)
+    d = rays[:, 4:7]
+    tMax = rays[:, 7]
+    r = radius * (1 + 1e-6) + 1e-9
+    a = (d * d).sum(axis=1)
+    b = (d * o).sum(axis=1)
+    c = (o * o).sum(axis=1) - r * r
+    disc = b * b - a * c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sq = np.sqrt(np.maximum(disc, 0.0))
+        near = (-b - sq) / a
+        far = (-b + sq) / a
+        through = (disc >= 0) & (far >= -1e-9) & (near <= tMax * (1 + 1e-6) + 1e-9)
+    # degenerate rays: assume the worst
+    return through | (a == 0)
+
+def _dilate(mask):
+    out = mask.copy()
+    out[1:] |= mask[:-1]
+    out[:-1] |= mask[1:]
+    out[:, 1:] |= mask[:, :-1]
+    out[:, :-1] |= mask[:, 1:]
+    return out
+
+# Renders frames of scene at w*h. The first frame is traced in full; every
+# later call of render() traces only the pixels that objects added to,
+# removed from or changed in scene.objects since the previous call can have
+# affected, and gives the same image a full render would. Anything else
+# changing (camera, lights, render settings, the order of the objects) or a
+# changed object without bounds makes it trace the whole frame again.
+# Frames are traced in this process, and Russian roulette isn't supported:
+# its random numbers depend on the order the rays are traced in. Neither
+# are shadow maps, which any object can change everywhere.
+# retraced is the number of pixels traced for the last frame.
+class IncrementalRenderer(object):
+    def __init__(self, scene, w, h, depth=5):
+        self.scene = scene
+        self.w = w
+        self.h = h
+        self.depth = depth
+        self.image = None
+        self.retraced = 0
+        self._settings = None
+        self._objects = {}
+        self._order = []
+
+    # Returns the frame as a PIL image, the same one each call.
+    def render(self):
+        scene = self.scene
+        if scene.russianRoulette:
+            raise ValueError("Incremental rendering can't reproduce Russian roulette")
+        if scene.shadowMaps is not None:
+            raise ValueError("Incremental rendering can't track shadow maps")
+        settings = pickle.dumps((scene.camera, tuple(scene.light), scene.lights, scene.lightThreshold,
+                                 scene.BackgroundColor, scene.supersampling, scene.adaptive,
+                                 scene.edgeThreshold, scene.minContribution, scene.wavefront,
+                                 self.depth),
+                                pickle.HIGHEST_PROTOCOL)
+        objects = dict((id(o), (o, pickleContent(o), boundsOf(o))) for o in scene.objects)
+        order = [id(o) for o in scene.objects]
+        changed = [key for key in set(objects) | set(self._objects)
+                   if key not in objects or key not in self._objects or
+                   objects[key][1] != self._objects[key][1]]
+        bounds = [self._objects[key][2] for key in changed if key in self._objects] + \
+                 [objects[key][2] for key in changed if key in objects]
+        kept = [key for key in order if key in self._objects]
+        reorder = kept != [key for key in self._order if key in objects]
+        full = self.image is None or settings != self._settings or reorder or None in bounds
+        self._settings, self._objects, self._order = settings, objects, order
+
+        scene.stats = RenderStats()
+        if changed:
+            # the acceleration structures and hints hold the old objects
+            scene.occluderHints.clear()
+            if scene.compiled is not None:
+                scene.compile()
+            if scene.bvh is not None:
+                scene.buildBVH()
+            if scene.grid is not None:
+                scene.buildGrid()
+            if scene.shadowCasters is not None:
+                scene.buildShadowCasters()
+        if full:
+            self._reset()
+            dirty = np.arange(self.w * self.h)
+        elif changed:
+            ids = np.array(changed, dtype=np.int64)
+            affected = np.in1d(self.touched[:, 1], ids)
+            dirty = [self.touched[affected, 0]]
+            for centre, radius in bounds:
+                dirty.append(self.rays[raysThroughSphere(self.rays, centre, radius), 0].astype(np.int64))
+            dirty = np.unique(np.concatenate(dirty))
+        else:
+            dirty = np.zeros(0, dtype=np.int64)
+        self._retrace(dirty)
+        return self.image
+
+    def _reset(self):
+        n = self.w * self.h
+        origins, directions = self.scene.camera.getPrimaryRays(self.w, self.h)
+        self.origins = origins.reshape(-1, 3)
+        self.directions = directions.reshape(-1, 3)
+        self.colors = np.zeros((n, 3))
+        self.ids = np.full(n, -1, dtype=np.int64)
+        self.edges = np.zeros(n, dtype=bool)
+        self.rays = np.zeros((0, 8))
+        self.touched = np.zeros((0, 2), dtype=np.int64)
+        self.frame = np.empty((self.h, self.w, 3), dtype=np.uint8)
+        self.image = Image.new("RGB", (self.w, self.h), (0,0,255))
+
+    # Traces the camera rays of pixels (flat indices) again, replacing what
+    # was logged and stored for them.
+    def _trace(self, pixels):
+        self._forget(pixels)
+        if not len(pixels):
+            return
+        colors, ids = self.scene.tracePrimary(self.origins[pixels], self.directions[pixels], self.depth,
+                                              pixels=pixels)
+        self.colors[pixels] = colors
+        self.ids[pixels] = ids
+
+    def _forget(self, pixels):
+        self.rays = self.rays[~np.in1d(self.rays[:, 0], pixels)]
+        self.touched = self.touched[~np.in1d(self.touched[:, 0], pixels)]
+
+    def _retrace(self, dirty):
+        scene, w, h = self.scene, self.w, self.h
+        n = scene.supersampling
+        log = scene.rayLog = RayLog()
+        try:
+            if n > 1 and not scene.adaptive:
+                # every pixel is supersampled, its camera ray isn't needed
+                self._forget(dirty)
+            else:
+                self._trace(dirty)
+            final = {}
+            redo = dirty
+            if n > 1:
+                if scene.adaptive:
+                    # a pixel's neighbours decide whether it is on an edge
+                    mask = np.zeros(w * h, dtype=bool)
+                    mask[dirty] = True
+                    region = np.flatnonzero(_dilate(mask.reshape(h, w)))
+                    edges = findEdges(self.colors.reshape(h, w, 3), self.ids.reshape(h, w),
+                                      scene.edgeThreshold).reshape(-1)[region]
+                    flipped = region[edges != self.edges[region]]
+                    self.edges[region] = edges
+                    # drop the sub-pixel rays they had, log their camera rays again
+                    self._trace(np.setdiff1d(flipped, dirty))
+                    redo = np.union1d(dirty, flipped)
+                else:
+                    self.edges[:] = True
+                sub = redo[self.edges[redo]]
+                if len(sub):
+                    origins, directions = scene.camera.getSubpixelRays(w, h, sub % w, sub // w, n)
+                    samples, ids = scene.tracePrimary(origins.reshape(-1, 3), directions.reshape(-1, 3),
+                                                      self.depth, pixels=np.repeat(sub, n * n))
+                    final = dict(zip(sub.tolist(), samples.reshape(len(sub), n * n, 3).mean(axis=1)))
+        finally:
+            scene.rayLog = None
+        rays, touched = log.arrays()
+        self.rays = np.concatenate((self.rays, rays))
+        self.touched = np.concatenate((self.touched, touched))
+        frame = self.frame.reshape(-1, 3)
+        frame[redo] = toPixels(self.colors[redo])
+        if final:
+            sub = np.array(list(final), dtype=np.int64)
+            frame[sub] = toPixels(np.array([final[p] for p in sub.tolist()]))
+        self.image.frombytes(self.frame.tobytes())
+        self.retraced = len(redo)
@@ -0,0 +1,131 @@
+import math
+import numpy as np
+import euclid
+
+# Point lights for scenes lit by more than Scene.light's single point.
+# A light's contribution at a surface point is
+#   power * |cos(angle between surface normal and direction to the light)|
+#         * falloff(squared distance to the light)
+# and is dropped (culled) without a shadow ray if, times the intensity of
+# the ray being shaded, it is below Scene.lightThreshold. With a threshold
+# every light with a falloff only reaches so far; a LightGrid finds the
+# lights that reach a point without looking at the others.
+
+# Lights reaching more cells than this are checked at every point instead
+# of being listed in the cells.
+MAX_CELLS_PER_LIGHT = 4096
+
+class PointLight(object):
+    # halfDistance: distance at which the light is half as strong as next
+    # to it, falling off with the inverse square of the distance beyond;
+    # None for a light as strong everywhere.
+    def __init__(self, position, power=1.0, halfDistance=None):
+        if not isinstance(position, euclid.Point3):
+            raise TypeError("Must provide Point3 for position")
+        self.position = position
+        self.power = power
+        self.halfDistance = halfDistance
+
+    # Distance factor at squared distance d2.
+    def falloff(self, d2):
+        if self.halfDistance is None:
+            return 1.0
+        h2 = self.halfDistance ** 2
+        return h2 / (h2 + d2)
+
+    # Distance beyond which the light contributes less than threshold
+    # anywhere; inf if it never falls that low, 0.0 if it never gets that
+    # high. Rounded up a little so that it never cuts off a light that
+    # exact culling would keep.
+    def reach(self, threshold):
+        if self.power < threshold:
+            return 0.0
+        if self.halfDistance is None or threshold <= 0:
+            return float('inf')
+        return self.halfDistance * math.sqrt(self.power / threshold - 1) * (1 + 1e-9) + 1e-9
+
+# Uniform hash grid over the spheres of influence (reach()) of lights for a
+# threshold, answering which lights may contribute at a point.
+class LightGrid(object):
+    def __init__(self, lights, threshold):
+        self.lights = lights
+        self.threshold = threshold
+        reach = np.array([l.reach(threshold) for l in lights], dtype=np.float64)
+        self.reach2 = reach ** 2
+        # lights checked at every point
+        self.everywhere = []
+        self.cells = {}
+        bounded = (reach > 0) & ~np.isinf(reach)
+        self.size = float(np.median(reach[bounded])) if bounded.any() else 1.0
+        for i in xrange(len(lights)):
+            if reach[i] == 0:
+                continue
+            if not bounded[i]:
+                self.everywhere.append(i)
+                continue
+            p = np.array(tuple(lights[i].position), dtype=np.float64)
+            lo = self._cell(p - reach[i])
+            hi = self._cell(p + reach[i])
+            if np.prod(hi - lo + 1) > MAX_CELLS_PER_LIGHT:
+                self.everywhere.append(i)
+                continue
+            for x in xrange(lo[0], hi[0] + 1):
+                for y in xrange(lo[1], hi[1] + 1):
+                    for z in xrange(lo[2], hi[2] + 1):
+                        self.cells.setdefault((x, y, z), []).append(i)
+        self.positions = np.array([tuple(l.position) for l in lights], dtype=np.float64).reshape(-1, 3)
+        # for indices(), which works on plain floats
+        self._positions = self.positions.tolist()
+        self._reach2 = self.reach2.tolist()
+
+    def __len__(self):
+        return len(self.lights)
+
+    def _cell(self, p):
+        return np.floor(p / self.size).astype(int)
+
+    # Indices of the lights that may contribute at point (a Point3), in
+    # increasing order.
+    def indices(self, point):
+        x, y, z = point.x, point.y, point.z
+        key = (int(math.floor(x / self.size)), int(math.floor(y / self.size)),
+               int(math.floor(z / self.size)))
+        found = []
+        for i in self.cells.get(key, ()):
+            px, py, pz = self._positions[i]
+            if (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2 <= self._reach2[i]:
+                found.append(i)
+        if self.everywhere:
+            found = sorted(found + self.everywhere)
+        return found
+
+    # indices() for an (N, 3) array of points, as (point, light) index
+    # pairs ordered by light.
+    def pairs(self, points):
+        cells = self._cell(points)
+        keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+        # points grouped by cell
+        byCell = np.argsort(inverse, kind='mergesort')
+        ends = np.cumsum(np.bincount(inverse, minlength=len(keys)))
+        pointIdx, lightIdx = [], []
+        for k, key in enumerate(keys.tolist()):
+            candidates = self.cells.get(tuple(key))
+            if not candidates:
+                continue
+            members = byCell[(ends[k - 1] if k else 0):ends[k]]
+            pointIdx.append(np.repeat(members, len(candidates)))
+            lightIdx.append(np.tile(candidates, len(members)))
+        if pointIdx:
+            pointIdx = np.concatenate(pointIdx)
+            lightIdx = np.concatenate(lightIdx)
+            d = points[pointIdx] - self.positions[lightIdx]
+            near = d[:, 0] ** 2 + d[:, 1] ** 2 + d[:, 2] ** 2 <= self.reach2[lightIdx]
+            pointIdx, lightIdx = pointIdx[near], lightIdx[near]
+        else:
+            pointIdx = lightIdx = np.zeros(0, dtype=np.intp)
+        if self.everywhere:
+            everywhere = np.array(self.everywhere, dtype=np.intp)
+            pointIdx = np.concatenate((pointIdx, np.repeat(np.arange(len(points)), len(everywhere))))
+            lightIdx = np.concatenate((lightIdx, np.tile(everywhere, len(points))))
+        order = np.argsort(lightIdx, kind='mergesort')
+        return pointIdx[order], lightIdx[order]
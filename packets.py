@@ -0,0 +1,60 @@
+import numpy as np
+
+# Shadow ray packets. The shadow rays a wave of wavefront.traceWavefront
+# casts towards one light all run through the light, so together they fit
+# in a circular cone with the light at its apex. Spheres outside the cone
+# can't block any of them and are left out before the rays are intersected
+# in bulk.
+
+# Scenes with fewer spheres than this are cheaper to test in full than to
+# cull packets against.
+MIN_SPHERES = 64
+
+# Slack on the angles and distances compared, so that rounding can only
+# keep a sphere that is outside, never drop one that is inside.
+EPSILON = 1e-9
+
+# Which spheres ((S, 3) centres, (S,) radii) may lie on a shadow ray from
+# one of points ((N, 3)) to light ((3,)). beyond: the rays go on past the
+# light, as Scene.light's do; otherwise they end there. Returns an (S,) bool
+# array, all True if the rays spread too wide for a cone to help.
+def spheresOnShadowRays(centres, radii, light, points, beyond):
+    keep = np.ones(len(radii), dtype=bool)
+    if not len(points) or not len(radii):
+        return keep
+    toPoints = points - light
+    distance = np.sqrt((toPoints * toPoints).sum(axis=1))
+    if (distance == 0).any():
+        return keep
+    directions = toPoints / distance[:, np.newaxis]
+    axis = directions.sum(axis=0)
+    length = np.sqrt(axis.dot(axis))
+    if length == 0:
+        return keep
+    axis /= length
+    cosine = directions.dot(axis).min()
+    if cosine <= 0:
+        # a half-space or more
+        return keep
+    spread = np.arccos(min(cosine, 1.0))
+    return spheresInCone(centres, radii, light, axis, spread, distance.max(), beyond)
+
+# Which spheres ((S, 3) centres, (S,) radii) reach into the circular cone
+# with apex ((3,)), unit axis ((3,)) and half-angle spread (radians), cut
+# off length from the apex. beyond: the cone goes on, unbounded, on the
+# other side of the apex too. Returns an (S,) bool array. axis ((S, 3)),
+# spread and length ((S,)) may also give every sphere a cone of its own.
+def spheresInCone(centres, radii, apex, axis, spread, length, beyond):
+    toCentres = centres - apex
+    d = np.sqrt((toCentres * toCentres).sum(axis=1))
+    inside = d <= radii * (1 + EPSILON) + EPSILON
+    spread = spread + EPSILON
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angle = np.arccos(np.clip((toCentres * axis).sum(axis=1) / d, -1.0, 1.0))
+        # half the angle the sphere takes up as seen from the apex
+        size = np.arcsin(np.minimum(radii / d, 1.0))
+    near = (angle <= spread + size + EPSILON) & \
+           (d - radii <= length * (1 + EPSILON) + EPSILON)
+    if beyond:
+        near |= np.pi - angle <= spread + size + EPSILON
+    return inside | near
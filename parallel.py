@@ -0,0 +1,72 @@
+import multiprocessing
+from collections import deque
+import cPickle as pickle
+
+# Tile-parallel rendering over a process pool.
+# The scene is pickled once in the parent; every worker unpickles it once in
+# its initializer (euclid's slotted classes go through the __getstate__ /
+# __setstate__ that _EuclidMetaclass generates) and keeps it for all the
+# tiles it is handed. Tasks only carry tile coordinates.
+
+# Splits a w*h frame into (x0, y0, x1, y1) tiles of at most size*size
+# pixels, end-exclusive, in scanline order.
+def splitTiles(w, h, size=32):
+    tiles = []
+    for y0 in xrange(0, h, size):
+        for x0 in xrange(0, w, size):
+            tiles.append((x0, y0, min(x0 + size, w), min(y0 + size, h)))
+    return tiles
+
+_scene = None
+
+def _initWorker(sceneData):
+    global _scene
+    _scene = pickle.loads(sceneData)
+
+def _renderTile(task):
+    w, h, tile, depth = task
+    _scene.stats.reset()
+    rows = _scene.renderTile(w, h, tile, depth)
+    return tile, rows, _scene.stats
+
+# Renders scene tile by tile in a pool of processes (all cores if None).
+# Yields (tile, rows, stats) in completion order, rows being what
+# scene.renderTile returns for that tile and stats the scene.stats collected
+# while tracing it. The pixels are the same as when calling
+# scene.renderTile for every tile in this process.
+# depth may be a function of the tile, as for raytrace.renderTiles. It is
+# then called as each tile is handed to the pool, which is kept only a few
+# tiles per process ahead of the results consumed so far; those are yielded
+# in tile order instead. tiles, if given, are the ones to trace instead of
+# all of them.
+def renderParallel(scene, w, h, depth=5, tileSize=32, processes=None, tiles=None):
+    sceneData = pickle.dumps(scene, pickle.HIGHEST_PROTOCOL)
+    if tiles is None:
+        tiles = splitTiles(w, h, tileSize)
+    pool = multiprocessing.Pool(processes, _initWorker, (sceneData,))
+    try:
+        if callable(depth):
+            results = _renderWindowed(pool, w, h, tiles, depth, 2 * (processes or multiprocessing.cpu_count()))
+        else:
+            results = pool.imap_unordered(_renderTile, [(w, h, tile, depth) for tile in tiles])
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Keeps at most window tiles in the pool, asking depth(tile) for each one
+# as it is submitted.
+def _renderWindowed(pool, w, h, tiles, depth, window):
+    pending = deque()
+    tiles = iter(tiles)
+    for tile in tiles:
+        pending.append(pool.apply_async(_renderTile, ((w, h, tile, depth(tile)),)))
+        if len(pending) == window:
+            break
+    while pending:
+        yield pending.popleft().get()
+        for tile in tiles:
+            pending.append(pool.apply_async(_renderTile, ((w, h, tile, depth(tile)),)))
+            break
@@ -1,11 +1,29 @@
 from PIL import Image
+import numpy as np
 import euclid
 from math import floor
 from shapes import RaycastingSphere, RaycastingPlane
 from camera import Camera
+from batch import SELF_INTERSECT_LENGTH
+from compiled import CompiledScene, MIN_OBJECTS
+from wavefront import traceWavefront
+from bvh import BVH
+from grid import Grid
+from lights import LightGrid
+from casters import ShadowCasters
+from shadowmap import ShadowMap
+from stats import RenderStats
+from parallel import splitTiles, renderParallel
+from tilecache import tileKeys
 from time import time
+import itertools
+from itertools import chain
+import random
 
 
+# Intensity of one step of an 8-bit color channel at full brightness.
+MIN_VISIBLE_CONTRIBUTION = 1.0 / 255
+
 class RayColor:
     def __init__(self, intensity, rgb=(0,0,0)):
         self.intensity = intensity
@@ -15,8 +33,6 @@ class RayColor:
         i = self.intensity
         return (int(self.rgb[0]*i), int(self.rgb[1]*i), int(self.rgb[2]*i))
 
-distances = []
-
 def reflect(point, obj, ray):
     if type(obj) == RaycastingSphere:
         n = (point - obj.c).normalized()
@@ -28,6 +44,23 @@ def reflect(point, obj, ray):
         raise TypeError("Unknown shape")
     return euclid.Ray3(point, 2 * n.dot(v) * n - v)
 
+# Pixels of an (h, w, 3) float image whose color differs from one of their
+# four neighbours' by more than threshold in some channel, or whose ids
+# ((h, w) array, what the pixel's ray hit first) differ. Returns an (h, w)
+# bool array.
+def findEdges(colors, ids, threshold):
+    edges = np.zeros(ids.shape, dtype=bool)
+    for axis in (0, 1):
+        differs = np.abs(np.diff(colors, axis=axis)).max(axis=2) > threshold
+        differs |= np.diff(ids, axis=axis) != 0
+        if axis == 0:
+            edges[1:] |= differs
+            edges[:-1] |= differs
+        else:
+            edges[:, 1:] |= differs
+            edges[:, :-1] |= differs
+    return edges
+
 # Supply 2 RayColors, returns RGB tuple that must be floor()'d before used in PIL
 def blend(*colors):
     intensity = 0.0
@@ -40,36 +73,154 @@ def blend(*colors):
         rgb[x] = reduce(lambda s, c: s + c.rgb[x] * c.intensity, colors)   
     return RayColor(intensity, rgb) 
 
-class Scene:
+# objectIds, unique within the process; see SceneObjects.
+_objectIds = itertools.count()
+
+# The list of a Scene's objects; lists assigned to Scene.objects are copied
+# into one. Every object put into it gets an objectId, an int no other
+# object added to a scene in this process had, which findIntersect and
+# findOccluder compare to recognise the object a ray starts from. An object
+# keeps its id while it stays in the list and gets a new one when added
+# again, anywhere. changes counts the objects added and removed, see
+# Scene.occluded.
+class SceneObjects(list):
+    def __init__(self, objects = ()):
+        list.__init__(self)
+        self.changes = 0
+        self.extend(objects)
+
+    def _added(self, obj):
+        obj.objectId = next(_objectIds)
+        self.changes += 1
+        return obj
+
+    def append(self, obj):
+        list.append(self, self._added(obj))
+
+    def insert(self, index, obj):
+        list.insert(self, index, self._added(obj))
+
+    def extend(self, objects):
+        list.extend(self, [self._added(o) for o in objects])
+
+    def __iadd__(self, objects):
+        self.extend(objects)
+        return self
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [self._added(o) for o in value]
+        else:
+            value = self._added(value)
+        list.__setitem__(self, index, value)
+
+    def __setslice__(self, i, j, objects):
+        self.__setitem__(slice(i, j), objects)
+
+    def remove(self, obj):
+        list.remove(self, obj)
+        self.changes += 1
+
+    def pop(self, index = -1):
+        self.changes += 1
+        return list.pop(self, index)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.changes += 1
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    # unpickled as they are, without new ids
+    def __reduce__(self):
+        return (_sceneObjects, (list(self),))
+
+def _sceneObjects(objects):
+    global _objectIds
+    l = SceneObjects()
+    list.extend(l, objects)
+    # objects added in this process from now on mustn't reuse their ids
+    last = max([o.objectId for o in objects] + [-1])
+    _objectIds = itertools.count(max(next(_objectIds), last + 1))
+    return l
+
+class Scene(object):
     def __init__(self, cwidth = 180, cheight = 180):
         self.BackgroundColor = (255, 0, 255)
-        self.objects = []
+        self.objects = SceneObjects()
         self.camera = Camera(zoom=0.15, rotation=(0, 16, -4), width=cwidth, height=cheight)
         # light source is a single point for now
         self.light = euclid.Point3(0.0, 0.0, 0.0)
+        # lights.PointLights lighting the scene instead of self.light if
+        # there are any. Lights contributing less than lightThreshold of a
+        # ray's intensity at a point are culled before their shadow ray;
+        # unlike self.light's, objects beyond a light cast no shadow.
+        self.lights = []
+        self.lightThreshold = MIN_VISIBLE_CONTRIBUTION
+        # set by buildLightGrid()
+        self.lightGrid = None
+        # set by compile()
+        self.compiled = None
+        # trace reflections breadth-first with wavefront.traceWavefront
+        # instead of recursing in trace(); needs compile()
+        self.wavefront = False
+        # Reflection rays carrying less than minContribution of the pixel's
+        # intensity are not traced (MIN_VISIBLE_CONTRIBUTION is one 8-bit
+        # step). With russianRoulette they are instead traced with
+        # probability contribution / minContribution and weighted up to
+        # minContribution, which keeps the expected result unchanged. The
+        # roulette is seeded per tile, but wavefront tracing draws its own
+        # numbers, so its pixels differ from the recursive path's.
+        self.minContribution = 0.0
+        self.russianRoulette = False
+        # reseeded for every tile by renderTile
+        self.rng = random.Random()
+        # Anti-aliasing: with supersampling n > 1, pixels on an edge (see
+        # findEdges, edgeThreshold is in 8-bit color steps) are traced again
+        # with n*n rays spread over the pixel and get their average.
+        # adaptive = False supersamples every pixel instead.
+        self.supersampling = 1
+        self.adaptive = True
+        self.edgeThreshold = 8
+        # an incremental.RayLog recording every ray traced, or None
+        self.rayLog = None
+        # set by buildBVH() and buildGrid(); the BVH wins if both are
+        self.bvh = None
+        self.grid = None
+        # set by buildShadowCasters()
+        self.shadowCasters = None
+        # shadowmap.ShadowMaps by light position, for approximate shadows;
+        # see buildShadowMaps() and render()
+        self.shadowMaps = None
+        # last shadow blocker per light position, see occluded(). Dropped
+        # for every frame, by compile() and the build methods and when
+        # objects are added or removed (_hintsChanges is the objects.changes
+        # they were found at).
+        self.occluderHints = {}
+        self._hintsChanges = None
+        # statistics of the tile being traced, see render()
+        self.stats = RenderStats()
 
+    def _setObjects(self, objects):
+        if not isinstance(objects, SceneObjects):
+            objects = SceneObjects(objects)
+        self._objects = objects
+        self._hintsChanges = None
+
+    # always a SceneObjects
+    objects = property(lambda self: self._objects, _setObjects)
 
     def getColor(self, intersect, obj, intensity):
+        if self.lights:
+            return self.getLitColor(intersect, obj, intensity)
         # DEBUG: no shadows
         #return RayColor(intensity, obj.getColor(intersect))
         # get a ray from the intersect to the source of light
         vectorToLight = self.light - intersect
         rayToLight = euclid.Ray3(intersect, vectorToLight)
-        for o in self.objects:
-            i = o.intersect(rayToLight)
-            if obj == o:
-                if type(i) == euclid.Point3:
-                    # often means intercept with self
-                    continue
-                elif not i: # is None
-                    continue # no intercept
-                # otherwise find penetration
-                lenI = abs(i)
-                distances.append(lenI)
-                if lenI < 0.2:
-                    continue
-            if i: # intersect, so is in shadow                
-                return RayColor(intensity, (0,0,0))
+        if self.occluded(rayToLight, obj):
+            return RayColor(intensity, (0,0,0))
         # otherwise not in shadow
         # find intensity depending on angle to light.
         if type(obj) == RaycastingPlane:
@@ -79,65 +230,460 @@ class Scene:
         strength = abs(vectorToLight.normalized().dot(normal))
         return RayColor(intensity * strength, obj.getColor(intersect))
 
-    def findIntersect(self, ray, previousObject = None):
-        minD = float('inf')
-        intersect = None
-        obj = None
-        for o in self.objects:
-            inter = o.intersect(ray)
-            if o == previousObject:
-                if type(inter) == euclid.Point3:
-                    # intersection with self
-                    continue
-                elif inter == None:
+    # getColor with self.lights: the color of obj lit by the lights that
+    # reach intersect and aren't culled or blocked, their contributions
+    # added up.
+    def getLitColor(self, intersect, obj, intensity):
+        if type(obj) == RaycastingPlane:
+            normal = obj.shape.n
+        elif type(obj) == RaycastingSphere:
+            normal = (intersect - obj.shape.c).normalize()
+        if self.lightGrid is None:
+            lights = self.lights
+        else:
+            lights = [self.lights[i] for i in self.lightGrid.indices(intersect)]
+        culled = len(self.lights) - len(lights)
+        total = 0.0
+        lit = False
+        for light in lights:
+            vectorToLight = light.position - intersect
+            strength = light.power * abs(vectorToLight.normalized().dot(normal)) * \
+                       light.falloff(vectorToLight.magnitude_squared())
+            if intensity * strength < self.lightThreshold:
+                culled += 1
+                continue
+            # the shadow ray ends at the light
+            if self.occluded(euclid.LineSegment3(intersect, vectorToLight), obj, light.position):
+                continue
+            total += strength
+            lit = True
+        self.stats.rays.culled += culled
+        if not lit:
+            return RayColor(intensity, (0,0,0))
+        return RayColor(intensity * total, obj.getColor(intersect))
+
+    # Shadow query: True if anything lies on ray, which leaves from obj
+    # towards light (self.light by default). Stops at the first blocker and
+    # builds no hit geometry. The blocker found last for a light is tried
+    # first, neighbouring shadow rays are usually blocked by the same object.
+    # ray may be a euclid.LineSegment3 ending at the light, then only
+    # objects between the two count.
+    def occluded(self, ray, obj, light = None):
+        counters = self.stats.rays
+        counters.shadow += 1
+        key = tuple(self.light if light is None else light)
+        if self.shadowMaps is not None:
+            if self.shadowMaps[key].occludedPoint(ray.p):
+                counters.occluded += 1
+                return True
+            return False
+        segment = isinstance(ray, euclid.LineSegment3)
+        log = self.rayLog
+        if log is not None:
+            log.addRay(ray, 1.0 if segment else float('inf'), None)
+        if self._hintsChanges != self.objects.changes:
+            # a hint may have been removed from the scene
+            self.occluderHints.clear()
+            self._hintsChanges = self.objects.changes
+        hint = self.occluderHints.get(key)
+        if hint is not None and hint is not obj:
+            counters.tests[hint.__class__.__name__] += 1
+            if hint.occludes(ray):
+                counters.occluded += 1
+                if log is not None:
+                    log.touch(hint)
+                return True
+        accelerator = self.accelerator()
+        if self.shadowCasters is not None:
+            blocker = self.findOccluder(self.shadowCasters.casters(obj, key), ray, obj)
+        elif accelerator is not None:
+            blocker = self.findOccluder(accelerator.others, ray, obj)
+            if blocker is None:
+                blocker = accelerator.anyHit(ray, self.findOccluder, obj)
+        elif self.packed() is None:
+            blocker = self.findOccluder(self.objects, ray, obj)
+        else:
+            compiled = self.compiled
+            blocker = self.findOccluder(compiled.others, ray, obj)
+            if blocker is None:
+                own = compiled.indexOf(obj)
+                t, index = compiled.intersect((tuple(ray.p),), (tuple(ray.v),), (own,))
+                if index[0] >= 0 and (not segment or t[0] <= 1.0):
+                    blocker = compiled.objects[index[0]]
+                if own >= 0:
+                    # the packed arrays left obj out the way findOccluder does
+                    lenI = obj.penetration(ray)
+                    if lenI is not None:
+                        self.stats.penetration.add(lenI)
+            counters.tests[RaycastingSphere.__name__] += len(compiled.sphereIndex)
+            counters.tests[RaycastingPlane.__name__] += len(compiled.planeIndex)
+        if blocker is None:
+            return False
+        self.occluderHints[key] = blocker
+        counters.occluded += 1
+        if log is not None:
+            log.touch(blocker)
+        return True
+
+    # First of objects that lies on ray, or None. obj is the object the ray
+    # starts from, it only counts if the ray passes through enough of it.
+    def findOccluder(self, objects, ray, obj):
+        tests = self.stats.rays.tests
+        own = obj.objectId
+        for o in objects:
+            tests[o.__class__.__name__] += 1
+            if o.objectId == own:
+                lenI = o.penetration(ray)
+                if lenI is None:
+                    # no intercept, or only the surface the ray starts on
                     continue
-                # find length of intercept
-                lenI = abs(inter)
-                if lenI < 0.2:
+                self.stats.penetration.add(lenI)
+                if lenI < SELF_INTERSECT_LENGTH:
                     continue
-            if inter:  #intersects                
-                if type(inter) == euclid.LineSegment3:
-                    d = abs(ray.p - o.c) - o.r
-                    if d < minD:
-                        minD = d
-                        obj = o
-                        # if inter is a line segment, we require the closer point.
-                        L1 = abs(ray.p - inter.p1)
-                        L2 = abs(ray.p - inter.p2)
-                        if L1 > L2:
-                            intersect = inter.p2
-                        else:
-                            intersect = inter.p1
-                elif type(inter) == euclid.Point3:
-                    d = abs(inter - ray.p)
-                    if d < minD:
-                        minD = d
-                        obj = o
-                        intersect = inter
-                else:
-                    raise TypeError("Unknown type " + str(type(inter)))
-                        
-        if not obj:
-            return None,None
+                return o
+            if o.occludes(ray):
+                return o
+        return None
+
+    # Builds a bvh.BVH over the spheres in self.objects; findIntersect and
+    # the shadow test in getColor then only test objects whose boxes the ray
+    # passes through. Must be called again after self.objects changes; set
+    # self.bvh = None to go back to testing every object.
+    def buildBVH(self):
+        self.occluderHints.clear()
+        self.bvh = BVH(self.objects)
+        return self.bvh
+
+    # Builds a grid.Grid over the spheres in self.objects, used like
+    # buildBVH's tree. Better suited to dense clouds of similar spheres.
+    # Must be called again after self.objects changes; set self.grid = None
+    # to stop using it.
+    def buildGrid(self):
+        self.occluderHints.clear()
+        self.grid = Grid(self.objects)
+        return self.grid
+
+    # The BVH or grid findIntersect and occluded search, or None.
+    def accelerator(self):
+        if self.bvh is not None:
+            return self.bvh
+        return self.grid
+
+    # Builds a lights.LightGrid over self.lights; getColor then only looks
+    # at the lights that reach the point being shaded. Must be called again
+    # after self.lights or self.lightThreshold change; set
+    # self.lightGrid = None to go back to checking every light.
+    def buildLightGrid(self):
+        self.lightGrid = LightGrid(self.lights, self.lightThreshold)
+        return self.lightGrid
+
+    # Works out a casters.ShadowCasters for self.objects and the lights in
+    # use (self.lights, or self.light if there are none); shadow tests in
+    # getColor then only look at the objects that can shadow the one being
+    # shaded, in place of the BVH, grid or compiled arrays. Must be called
+    # again after objects or lights change; set self.shadowCasters = None
+    # to stop using it. Wavefront tracing doesn't use it.
+    def buildShadowCasters(self):
+        if self.lights:
+            lights = [(light.position, False) for light in self.lights]
+        else:
+            lights = [(self.light, True)]
+        self.occluderHints.clear()
+        self.shadowCasters = ShadowCasters(self.objects, lights)
+        return self.shadowCasters
+
+    # Traces a shadowmap.ShadowMap of resolution*resolution texels per
+    # cube face for each light in use (self.lights, or self.light if there
+    # are none); getColor then looks shadows up in them instead of casting
+    # shadow rays. Must be called again after objects or lights change; set
+    # self.shadowMaps = None to go back to exact shadows. render() can also
+    # use maps for a single frame.
+    def buildShadowMaps(self, resolution = 256, bias = 2.0):
+        positions = [light.position for light in self.lights] or [self.light]
+        self.shadowMaps = dict((tuple(p), ShadowMap(self.objects, p, resolution, bias)) for p in positions)
+        return self.shadowMaps
+
+    # Packs the geometry and materials of self.objects into the contiguous
+    # arrays of a compiled.CompiledScene; findIntersect then tests all
+    # spheres and planes in one vectorized pass, unless there are fewer than
+    # compiled.MIN_OBJECTS. Must be called again after self.objects changes;
+    # set self.compiled = None to go back to the plain per-object loop.
+    def compile(self):
+        self.occluderHints.clear()
+        self.compiled = CompiledScene(self.objects)
+        return self.compiled
+
+    # self.compiled if findIntersect and occluded should use it, else None.
+    def packed(self):
+        compiled = self.compiled
+        if compiled is None or len(compiled) < MIN_OBJECTS:
+            return None
+        return compiled
+
+    def findIntersect(self, ray, previousObject = None):
+        accelerator = self.accelerator()
+        if accelerator is not None:
+            t, obj = self.nearestIntersect(accelerator.others, ray, previousObject)
+            nearT, nearObj = accelerator.nearest(ray, t, self.nearestIntersect, previousObject)
+            if nearObj is not None:
+                t, obj = nearT, nearObj
+        elif self.packed() is None:
+            t, obj = self.nearestIntersect(self.objects, ray, previousObject)
         else:
-            return intersect, obj
+            compiled = self.compiled
+            t, obj = self.nearestIntersect(compiled.others, ray, previousObject)
+            packedT, index = compiled.intersect((tuple(ray.p),), (tuple(ray.v),), (compiled.indexOf(previousObject),))
+            packedT, index = float(packedT[0]), int(index[0])
+            if index >= 0 and packedT < t:
+                t, obj = packedT, compiled.objects[index]
+            tests = self.stats.rays.tests
+            tests[RaycastingSphere.__name__] += len(compiled.sphereIndex)
+            tests[RaycastingPlane.__name__] += len(compiled.planeIndex)
+        if self.rayLog is not None:
+            self.rayLog.addRay(ray, t if obj is not None else float('inf'), obj)
+        if obj is None:
+            self.stats.rays.misses += 1
+            return None,None
+        self.stats.rays.hits += 1
+        # only the winning hit is turned into a point
+        intersect = euclid.Point3(ray.p.x + t * ray.v.x,
+                                  ray.p.y + t * ray.v.y,
+                                  ray.p.z + t * ray.v.z)
+        return intersect, obj
+
+    # Tests ray against every object in objects, one at a time.
+    # Returns (t, obj) of the closest hit, the hit point being
+    # ray.p + t * ray.v; obj is None if nothing was hit.
+    def nearestIntersect(self, objects, ray, previousObject = None):
+        minT = float('inf')
+        obj = None
+        tests = self.stats.rays.tests
+        own = -1 if previousObject is None else previousObject.objectId
+        for o in objects:
+            tests[o.__class__.__name__] += 1
+            if o.objectId == own:
+                # the ray starts on o, it only counts if it passes through
+                # enough of it
+                lenI = o.penetration(ray)
+                if lenI is None or lenI < SELF_INTERSECT_LENGTH:
+                    continue
+            t = o.intersectT(ray)
+            if t is not None and t < minT:
+                minT = t
+                obj = o
+        return minT, obj
 
     def trace(self, ray, intensity, depth = 0, previousObject = None):
         depth -= 1
         if depth < 0:
             return RayColor(intensity, self.BackgroundColor)
         point, obj = self.findIntersect(ray, previousObject)
-        if obj == None: # no intersections
-            if previousObject != None: # try to get the 'original' color of the object
+        return self.shade(ray, point, obj, intensity, depth, previousObject)
+
+    # The rest of trace() once the ray found point on obj (both None on a miss).
+    def shade(self, ray, point, obj, intensity, depth, previousObject):
+        if obj is None: # no intersections
+            if previousObject is not None: # try to get the 'original' color of the object
                 return self.getColor(ray.p, previousObject, intensity)
             return RayColor(intensity, self.BackgroundColor)
         if obj.reflectionIndex == 0.0:
             return self.getColor(point, obj, intensity)
         # otherwise shoot off reflected rays
         col1 = self.getColor(point, obj, (1 - obj.reflectionIndex)*intensity)
-        col2 = self.trace(reflect(point, obj, ray), intensity * obj.reflectionIndex, depth, obj)
+        reflected = intensity * obj.reflectionIndex
+        if reflected < self.minContribution:
+            survival = reflected / self.minContribution
+            if not self.russianRoulette or self.rng.random() >= survival:
+                self.stats.rays.pruned += 1
+                return col1
+            reflected = self.minContribution
+        if depth >= 1:
+            # else trace() gives the background without tracing it
+            self.stats.rays.reflection += 1
+        col2 = self.trace(reflect(point, obj, ray), reflected, depth, obj)
         return blend(col1, col2)
 
+    # Traces camera rays given as (N, 3) origin and direction arrays like
+    # trace(ray, 1.0, depth). Returns their colors as an (N, 3) float array,
+    # RayColor.toRGB before rounding down, and an (N,) array identifying the
+    # object each ray hit first, -1 for none. pixels gives the frame pixel
+    # (y * w + x) each ray belongs to, for self.rayLog.
+    def tracePrimary(self, origins, directions, depth, seed = None, pixels = None):
+        self.stats.rays.primary += len(origins)
+        log = self.rayLog
+        if log is not None:
+            log.pixels = pixels
+        if self.wavefront:
+            intensity, rgb, first = traceWavefront(self, origins, directions, depth, seed)
+            return rgb * intensity[:, None], first
+        colors = np.empty((len(origins), 3))
+        ids = np.full(len(origins), -1, dtype=np.int64)
+        # tolist() hands euclid plain floats; it asserts on numpy scalars.
+        for i, (o, d) in enumerate(zip(origins.tolist(), directions.tolist())):
+            ray = euclid.Ray3(euclid.Point3(*o), euclid.Vector3(*d))
+            if log is not None:
+                log.pixel = int(pixels[i])
+            if depth < 1:
+                color = self.trace(ray, 1.0, depth)
+            else:
+                point, obj = self.findIntersect(ray)
+                color = self.shade(ray, point, obj, 1.0, depth - 1, None)
+                if obj is not None:
+                    ids[i] = id(obj)
+            intensity = color.intensity
+            colors[i] = (color.rgb[0]*intensity, color.rgb[1]*intensity, color.rgb[2]*intensity)
+        return colors, ids
+
+    # Traces the primary rays of tile (x0, y0, x1, y1) of a w*h frame.
+    # Returns the tile's pixels as a (rows, columns, 3) uint8 array.
+    def renderTile(self, w, h, tile, depth = 5):
+        # same random numbers for a tile whichever process traces it
+        seed = tile[1] * w + tile[0]
+        self.rng.seed(seed)
+        x0, y0, x1, y1 = tile
+        n = self.supersampling
+        if n > 1 and not self.adaptive:
+            # every pixel gets its n*n rays, one ray per pixel first would be wasted
+            colors = np.empty((y1 - y0, x1 - x0, 3))
+            edges = np.ones((y1 - y0, x1 - x0), dtype=bool)
+        else:
+            if n > 1:
+                # edges may run along the tile's border: trace the pixels around it too
+                outer = (max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, w), min(y1 + 1, h))
+            else:
+                outer = tile
+            origins, directions = self.camera.getPrimaryRays(w, h, outer)
+            height, width = origins.shape[:2]
+            colors, ids = self.tracePrimary(origins.reshape(-1, 3), directions.reshape(-1, 3), depth, seed)
+            colors = colors.reshape(height, width, 3)
+            # the pixels around the tile are the neighbouring tiles' own
+            border = height * width - (y1 - y0) * (x1 - x0)
+            self.stats.rays.primary -= border
+            self.stats.rays.border += border
+            if n > 1:
+                inner = (slice(y0 - outer[1], y1 - outer[1]), slice(x0 - outer[0], x1 - outer[0]))
+                edges = findEdges(colors, ids.reshape(height, width), self.edgeThreshold)[inner]
+                colors = colors[inner].copy()
+        if n > 1:
+            ys, xs = np.nonzero(edges)
+            if len(xs):
+                origins, directions = self.camera.getSubpixelRays(w, h, xs + x0, ys + y0, n)
+                samples, ids = self.tracePrimary(origins.reshape(-1, 3), directions.reshape(-1, 3), depth, seed + 1)
+                colors[ys, xs] = samples.reshape(len(xs), n * n, 3).mean(axis=1)
+        return toPixels(colors)
+
+# Float RGB colors as uint8 pixels, truncated and clipped to [0, 255] like
+# PIL does when setting pixels from tuples.
+def toPixels(colors):
+    return np.clip(colors.astype(int), 0, 255).astype(np.uint8)
+
+# Traces the tiles of a w*h frame one after the other in this process.
+# Yields (tile, rows, stats) like parallel.renderParallel; stats is
+# scene.stats, reset for every tile. depth is the trace depth, or a
+# function of the tile giving it, called just before tracing that tile.
+# tiles, if given, are the ones to trace instead of all of them.
+def renderTiles(scene, w, h, depth = 5, tileSize = 32, tiles = None):
+    if tiles is None:
+        tiles = splitTiles(w, h, tileSize)
+    for tile in tiles:
+        scene.stats.reset()
+        tileDepth = depth(tile) if callable(depth) else depth
+        rows = scene.renderTile(w, h, tile, tileDepth)
+        yield tile, rows, scene.stats
+
+# Trace depth for the tiles of a frame that should cast at most budget rays
+# in all. After every traced tile (see add) the rays per pixel it took are
+# extrapolated over the pixels left; if that would overrun what remains of
+# the budget, the tiles traced from then on get one level less depth, down
+# to 1. The depth never goes back up within a frame.
+class RayBudget(object):
+    def __init__(self, depth, budget, pixels):
+        self.depth = depth
+        self.budget = budget
+        self.pixels = pixels
+        self.rays = 0
+        self.done = 0
+        self.rate = None
+
+    def add(self, tile, stats):
+        x0, y0, x1, y1 = tile
+        tilePixels = (x1 - x0) * (y1 - y0)
+        tileRays = stats.rays.total()
+        self.rays += tileRays
+        self.done += tilePixels
+        self.rate = tileRays / float(tilePixels)
+
+    def __call__(self, tile):
+        if self.rate is not None and self.depth > 1:
+            if self.rate * (self.pixels - self.done) > self.budget - self.rays:
+                self.depth -= 1
+        return self.depth
+
+# Renders scene into a new w*h image, tile by tile.
+# processes > 1 (or None for one per core) traces the tiles in a process
+# pool; the image is identical to the processes=1 one. Afterwards
+# scene.stats holds the statistics of the whole frame. onTile, if given, is
+# called with (tile, stats) as every tile finishes; stats is only valid
+# during the call.
+# rayBudget caps the rays of the frame through a RayBudget. Which tiles get
+# less depth depends on the order they finish in, so with a budget pool
+# renders can differ from serial ones and from each other.
+# cache, a tilecache.TileCache, supplies the tiles it has for the frame and
+# stores the others once traced; tiles from it are passed to onTile with
+# empty stats. It can't be combined with rayBudget.
+# shadowMap, a resolution, makes this frame's shadows approximate, looked up
+# in shadow maps (see Scene.buildShadowMaps) traced for it, for previews.
+def render(scene, w, h, depth = 5, processes = 1, tileSize = 32, onTile = None, rayBudget = None,
+           cache = None, shadowMap = None):
+    if shadowMap is not None:
+        shadowMaps = scene.shadowMaps
+        scene.buildShadowMaps(shadowMap)
+        try:
+            return render(scene, w, h, depth, processes, tileSize, onTile, rayBudget, cache)
+        finally:
+            scene.shadowMaps = shadowMaps
+    # every frame starts without hints, like the tiles of a pool
+    scene.occluderHints.clear()
+    # row-major RGB framebuffer, made into the image at the end
+    frame = np.empty((h, w, 3), dtype=np.uint8)
+    tiles = splitTiles(w, h, tileSize)
+    cached = []
+    if cache is not None:
+        if rayBudget is not None:
+            raise ValueError("A ray budget makes the depth of tiles unknown in advance, can't cache them")
+        keys = tileKeys(scene, w, h, tiles, depth)
+        for tile in tiles:
+            rows = cache.get(keys[tile])
+            if rows is not None:
+                cached.append((tile, rows, RenderStats()))
+        done = set(tile for tile, rows, stats in cached)
+        tiles = [tile for tile in tiles if tile not in done]
+    budget = None
+    if rayBudget is not None:
+        depth = budget = RayBudget(depth, rayBudget, w * h)
+    if not tiles:
+        results = []
+    elif processes == 1:
+        results = renderTiles(scene, w, h, depth, tileSize, tiles)
+    else:
+        results = renderParallel(scene, w, h, depth, tileSize, processes, tiles)
+    # tiles reset scene.stats, leave the caller's copy of the last frame's alone
+    scene.stats = RenderStats()
+    frameStats = RenderStats()
+    for tile, rows, stats in chain(cached, results):
+        frameStats.merge(stats)
+        if cache is not None and tile not in done:
+            cache.put(keys[tile], rows)
+        if budget is not None:
+            budget.add(tile, stats)
+        if onTile is not None:
+            onTile(tile, stats)
+        x0, y0, x1, y1 = tile
+        frame[y0:y1, x0:x1] = rows
+    scene.stats = frameStats
+    if cache is not None:
+        cache.evict()
+    return Image.frombuffer("RGB", (w, h), frame, "raw", "RGB", 0, 1)
 
 if __name__=="__main__":
     #import rpdb2; rpdb2.start_embedded_debugger('1234')
@@ -158,21 +704,10 @@ if __name__=="__main__":
     """scene.objects.append(RaycastingPlane((0,0,0), 
         euclid.Point3(0, 0, 5)))
     scene.objects[-1].reflectionIndex = 0.2"""
-    im = Image.new("RGB", (imgW, imgH), (0,0,255))
-    pixels = im.load()
-    for x, y, point in scene.camera.getPixelCoords(imgW, imgH):
-        color = scene.trace(euclid.Ray3(scene.camera.focus, point-scene.camera.focus), 1.0, 5)
-        if color.__class__.__name__ == "RayColor":
-            pixels[x,y] = color.toRGB()
-        elif type(color)==tuple:
-            pixels[x,y] = color
-        else:
-            raise TypeError("unknown color type: " + str(type(color)) + " containing:\n" + repr(color))
-    if not len(distances) < 2:
-        print "average:" + str(reduce(lambda x,y: x + y, distances)/float(len(distances)))
-        print "min:" + str(reduce(lambda x,y: x if x < y else y, distances))
-        distances.insert(0, 0.0)
-        print "number of 0.0s:" + str(reduce(lambda x,y: x+1 if y == 0.0 else x, distances))
+    im = render(scene, imgW, imgH, 5, processes = None)
+    report = scene.stats.report()
+    if report:
+        print report
     #im2 = im.resize((256,256), Image.ANTIALIAS)
     #im.save("/home/skyrunner/upload/imgs/test.png")
     im.save("out/test.png")
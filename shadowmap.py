@@ -0,0 +1,112 @@
+import math
+import numpy as np
+import euclid
+from compiled import CompiledScene
+from packets import spheresInCone
+
+# Approximate shadows for previews. A ShadowMap holds, for every direction
+# out of a light, how far the nearest object is: a depth cube map of six
+# resolution*resolution faces, traced once with the compiled intersection
+# kernels. A point is then in shadow if the map has something nearer to
+# the light than it in the point's direction. bias is the slack allowed,
+# in texel widths at the point's distance, so that surfaces don't shadow
+# themselves between texel centres. Unlike exact Scene.light shadow rays,
+# the map doesn't see objects beyond the light.
+
+# Texels per side of the blocks a face is traced in; each block's rays are
+# only intersected with the spheres in its cone.
+BLOCK = 16
+
+class ShadowMap(object):
+    def __init__(self, objects, light, resolution=256, bias=2.0):
+        self.light = np.array(tuple(light), dtype=np.float64)
+        self._lightTuple = tuple(self.light.tolist())
+        self.resolution = resolution
+        self.bias = bias
+        compiled = CompiledScene(objects)
+        n = resolution
+        centres = (np.arange(n) + 0.5) / n * 2 - 1
+        # face 2a + 1 looks along +axis a, face 2a along -axis a; texel
+        # (i, j) of it towards the other two axes, in order
+        self.depth = np.empty((6, n, n))
+        for face in xrange(6):
+            axis, sign = face // 2, 1.0 if face % 2 else -1.0
+            for i0 in xrange(0, n, BLOCK):
+                for j0 in xrange(0, n, BLOCK):
+                    u, v = np.meshgrid(centres[i0:i0 + BLOCK], centres[j0:j0 + BLOCK], indexing='ij')
+                    directions = np.empty(u.shape + (3,))
+                    directions[..., axis] = sign
+                    directions[..., (axis + 1) % 3] = u
+                    directions[..., (axis + 2) % 3] = v
+                    directions = directions.reshape(-1, 3)
+                    self.depth[face, i0:i0 + BLOCK, j0:j0 + BLOCK] = \
+                        self._trace(compiled, directions).reshape(u.shape)
+
+    # Distance from the light to the nearest object along each of
+    # directions ((N, 3), from one block), inf where there is none.
+    def _trace(self, compiled, directions):
+        length = np.sqrt((directions * directions).sum(axis=1))
+        unit = directions / length[:, np.newaxis]
+        axis = unit.sum(axis=0)
+        axis /= np.sqrt(axis.dot(axis))
+        spread = np.arccos(min(unit.dot(axis).min(), 1.0))
+        spheres = np.flatnonzero(spheresInCone(compiled.centres, compiled.radii, self.light, axis,
+                                               spread, float('inf'), False))
+        origins = np.empty_like(directions)
+        origins[:] = self.light
+        t, index = compiled.intersect(origins, directions, None, spheres)
+        for o in compiled.others:
+            for k, (p, d) in enumerate(zip(origins.tolist(), directions.tolist())):
+                hit = o.intersectT(euclid.Ray3(euclid.Point3(*p), euclid.Vector3(*d)))
+                if hit is not None and hit < t[k]:
+                    t[k] = hit
+        return t * length
+
+    # Which of points ((N, 3)) are in shadow.
+    def occluded(self, points):
+        toPoints = np.asarray(points, dtype=np.float64) - self.light
+        magnitude = np.abs(toPoints)
+        axis = magnitude.argmax(axis=1)
+        rows = np.arange(len(toPoints))
+        major = magnitude[rows, axis]
+        face = axis * 2 + (toPoints[rows, axis] > 0)
+        n = self.resolution
+        # points at the light look up any texel
+        major = np.where(major > 0, major, np.inf)
+        u = toPoints[rows, (axis + 1) % 3] / major
+        v = toPoints[rows, (axis + 2) % 3] / major
+        i = np.clip(np.floor((u + 1) / 2 * n), 0, n - 1).astype(np.intp)
+        j = np.clip(np.floor((v + 1) / 2 * n), 0, n - 1).astype(np.intp)
+        distance = np.sqrt((toPoints * toPoints).sum(axis=1))
+        bias = self.bias * distance * 2.0 / n
+        # a point at the light can't be shadowed
+        return ~np.isinf(major) & (self.depth[face, i, j] < distance - bias)
+
+    # occluded() for one point (a Point3) in plain floats, for the shadow
+    # rays the recursive path casts one at a time.
+    def occludedPoint(self, point):
+        lx, ly, lz = self._lightTuple
+        d = (point.x - lx, point.y - ly, point.z - lz)
+        ax, ay, az = abs(d[0]), abs(d[1]), abs(d[2])
+        if ax >= ay and ax >= az:
+            axis, major = 0, ax
+        elif ay >= az:
+            axis, major = 1, ay
+        else:
+            axis, major = 2, az
+        if major == 0:
+            # a point at the light can't be shadowed
+            return False
+        n = self.resolution
+        face = axis * 2 + (d[axis] > 0)
+        u = d[(axis + 1) % 3] / major
+        v = d[(axis + 2) % 3] / major
+        i = min(max(int(math.floor((u + 1) / 2 * n)), 0), n - 1)
+        j = min(max(int(math.floor((v + 1) / 2 * n)), 0), n - 1)
+        distance = math.sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2])
+        bias = self.bias * distance * 2.0 / n
+        return self.depth.item(face, i, j) < distance - bias
+
+    # Bytes taken by the depth map.
+    def nbytes(self):
+        return self.depth.nbytes
@@ -1,8 +1,13 @@
 import euclid
 from camera import rotateGeneric
 import math
+import copy
+import cPickle as pickle
 
 class RaycastingObject(object):
+    # set when the object is added to a scene, see raytrace.SceneObjects
+    objectId = None
+
     def __init__(self):
         self.color = (255,255,0)
         self.reflectionIndex = 0.0
@@ -15,6 +20,19 @@ class RaycastingObject(object):
 
     def distance(self, ray):
         raise BaseException("Must overload distance() in class " + type(self).__name__)
+
+    # Ray parameter t of the nearest hit (point = ray.p + t * ray.v), or None.
+    def intersectT(self, ray):
+        raise BaseException("Must overload intersectT() in class " + type(self).__name__)
+
+    # True if ray hits the object anywhere along it.
+    def occludes(self, ray):
+        raise BaseException("Must overload occludes() in class " + type(self).__name__)
+
+    # Length of ray inside the object, None if it misses or the object has
+    # no inside.
+    def penetration(self, ray):
+        raise BaseException("Must overload penetration() in class " + type(self).__name__)
         
     def __eq__(self, other):
         raise BaseException("Must overload __eq__() in class " + type(self).__name__)
@@ -22,20 +40,47 @@ class RaycastingObject(object):
     def __ne__(self, other):
         raise BaseException("Must overload __ne__() in class " + type(self).__name__)
 
+# obj pickled without its objectId, which changes whenever it is added to a
+# scene again: equal strings mean objects that render the same.
+def pickleContent(obj):
+    content = copy.copy(obj)
+    content.__dict__.pop('objectId', None)
+    return pickle.dumps(content, pickle.HIGHEST_PROTOCOL)
+
 class RaycastingSphere(RaycastingObject):
     def __init__(self, center, radius):
         super(RaycastingSphere, self).__init__()
         if type(center) != euclid.Point3:
             raise TypeError("Must provide Point3 for center")
-        self.c = center
-        self.r = radius
         self.shape = euclid.Sphere(center, radius)
 
+    # centre and radius are only stored once, in self.shape
+    def _setC(self, c):
+        self.shape.c = c
+
+    def _setR(self, r):
+        self.shape.r = r
+
+    c = property(lambda self: self.shape.c, _setC)
+    r = property(lambda self: self.shape.r, _setR)
+
     def intersect(self, ray):
         return self.shape.intersect(ray)
 
     def distance(self, ray):
         return self.shape.distance(ray)
+
+    def intersectT(self, ray):
+        return euclid.intersect_line3_sphere_t(ray, self.shape)
+
+    def occludes(self, ray):
+        return euclid.intersect_line3_sphere_span(ray, self.shape) is not None
+
+    def penetration(self, ray):
+        span = euclid.intersect_line3_sphere_span(ray, self.shape)
+        if span is None:
+            return None
+        return (span[1] - span[0]) * abs(ray.v)
         
     def __eq__(self, other):
         if type(self) != type(other):
@@ -80,6 +125,15 @@ class RaycastingPlane(RaycastingObject):
     def distance(self, ray):
         return self.shape.distance(ray)
 
+    def intersectT(self, ray):
+        return euclid.intersect_line3_plane_t(ray, self.shape)
+
+    def occludes(self, ray):
+        return euclid.intersect_line3_plane_t(ray, self.shape) is not None
+
+    def penetration(self, ray):
+        return None
+
     def getColor(self, coords=None):
         if not coords: 
             raise TypeError("Must provide a non-None argument for 'coords")
@@ -0,0 +1,150 @@
+import math
+from collections import Counter
+
+# Render statistics that take constant memory however many samples they see.
+
+# Streaming count/min/max/mean of a series of floats plus a histogram with
+# a fixed number of equal-width buckets over [low, high). Values below low
+# or at/above high are counted in underflow/overflow.
+class StreamingStats(object):
+    def __init__(self, low=0.0, high=1.0, buckets=10):
+        self.low = float(low)
+        self.high = float(high)
+        self.width = (self.high - self.low) / buckets
+        self.histogram = [0] * buckets
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+        self.zeros = 0
+        self.underflow = 0
+        self.overflow = 0
+        for i in xrange(len(self.histogram)):
+            self.histogram[i] = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        if value == 0.0:
+            self.zeros += 1
+        if value < self.low:
+            self.underflow += 1
+        elif value >= self.high:
+            self.overflow += 1
+        else:
+            self.histogram[int(math.floor((value - self.low) / self.width))] += 1
+
+    # Adds the samples counted by other, which must have the same buckets.
+    def merge(self, other):
+        if (other.low, other.high, len(other.histogram)) != (self.low, self.high, len(self.histogram)):
+            raise ValueError("Can't merge statistics with different histogram buckets")
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.zeros += other.zeros
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        for i, n in enumerate(other.histogram):
+            self.histogram[i] += n
+
+    def mean(self):
+        if not self.count:
+            return float('nan')
+        return self.total / self.count
+
+    # (low, high, count) for every bucket, underflow/overflow excluded.
+    def buckets(self):
+        return [(self.low + i * self.width, self.low + (i + 1) * self.width, n)
+                for i, n in enumerate(self.histogram)]
+
+# Counts of the rays a Scene traces and the object tests they cost.
+# primary: camera rays. border: camera rays of the pixels around a tile,
+# traced for adaptive supersampling to find edges along its border.
+# reflection: rays made by raytrace.reflect().
+# pruned: reflection rays not traced, see Scene.minContribution.
+# shadow: shadow rays cast by Scene.getColor, occluded of which were blocked.
+# culled: lights skipped without a shadow ray, see Scene.lights.
+# hits/misses: closest-hit queries (primary and reflection rays) that did or
+# did not find an object. tests: ray/object tests by object class name.
+class RayCounters(object):
+    def __init__(self):
+        self.tests = Counter()
+        self.reset()
+
+    def reset(self):
+        self.primary = 0
+        self.border = 0
+        self.reflection = 0
+        self.pruned = 0
+        self.shadow = 0
+        self.occluded = 0
+        self.culled = 0
+        self.hits = 0
+        self.misses = 0
+        self.tests.clear()
+
+    def merge(self, other):
+        self.primary += other.primary
+        self.border += other.border
+        self.reflection += other.reflection
+        self.pruned += other.pruned
+        self.shadow += other.shadow
+        self.occluded += other.occluded
+        self.culled += other.culled
+        self.hits += other.hits
+        self.misses += other.misses
+        self.tests.update(other.tests)
+
+    def total(self):
+        return self.primary + self.border + self.reflection + self.shadow
+
+    def report(self):
+        lines = ["rays: %d (primary %d, border %d, reflection %d, shadow %d)" %
+                     (self.total(), self.primary, self.border, self.reflection, self.shadow),
+                 "hits: %d, misses: %d, shadowed: %d, pruned: %d, culled lights: %d" %
+                     (self.hits, self.misses, self.occluded, self.pruned, self.culled)]
+        for name in sorted(self.tests):
+            lines.append("%s tests: %d" % (name, self.tests[name]))
+        return lines
+
+# Statistics a Scene collects while tracing one frame (or tile).
+# penetration: how far shadow rays travel inside the object they start
+# from, see Scene.findOccluder. Values under batch.SELF_INTERSECT_LENGTH are
+# treated as grazing the surface. Rays stopped by an occluder hint first, or
+# by an object ahead of their own in the order tested, record nothing; that
+# order differs between the plain, accelerated and compiled paths, so their
+# counts can differ a little. Shadow maps record nothing.
+# rays: RayCounters.
+class RenderStats(object):
+    def __init__(self):
+        self.penetration = StreamingStats(0.0, 0.4, 20)
+        self.rays = RayCounters()
+
+    def reset(self):
+        self.penetration.reset()
+        self.rays.reset()
+
+    def merge(self, other):
+        self.penetration.merge(other.penetration)
+        self.rays.merge(other.rays)
+
+    def report(self):
+        lines = self.rays.report()
+        p = self.penetration
+        if p.count >= 2:
+            lines.append("average:" + str(p.mean()))
+            lines.append("min:" + str(p.minimum))
+            lines.append("number of 0.0s:" + str(p.zeros))
+            lines.append("penetration histogram:")
+            for low, high, n in p.buckets():
+                lines.append("  [%.2f, %.2f): %d" % (low, high, n))
+            lines.append("  >= %.2f: %d" % (p.high, p.overflow))
+        return "\n".join(lines)
@@ -0,0 +1,196 @@
+import errno
+import hashlib
+import os
+import tempfile
+import time
+import cPickle as pickle
+import numpy as np
+from shapes import RaycastingSphere, pickleContent
+
+# On-disk cache of rendered tiles, addressed by a hash of everything a tile's
+# pixels depend on (see tileKeys). Tiles of a scene that only changed in
+# places it can't see are loaded instead of traced again.
+# Entries are files written to a temporary name and renamed into place, so
+# any number of processes can share a directory: readers see either a whole
+# entry or none. Reading an entry touches its mtime; evict() deletes the
+# least recently used entries until the cache fits in maxBytes.
+
+# Bump when a change to the renderer changes the pixels it makes.
+CACHE_VERSION = 2
+
+# Temporary files older than this (seconds) are left over from a process
+# that died while writing and get deleted by evict().
+STALE_SECONDS = 3600
+
+# Inward unit normals of the planes through the apex bounding the convex
+# cone spanned by generators ((k, 3) array), or None if the generators
+# don't span a pointed cone (it takes up a half-space or more).
+def _coneFacets(generators):
+    generators = generators[(generators != 0).any(axis=1)]
+    facets = []
+    for i in xrange(len(generators)):
+        for j in xrange(i + 1, len(generators)):
+            n = np.cross(generators[i], generators[j])
+            length = np.sqrt((n * n).sum())
+            if length == 0:
+                continue
+            n /= length
+            side = generators.dot(n)
+            scale = 1e-9 * np.abs(generators).max()
+            if (side >= -scale).all():
+                facets.append(n)
+            elif (side <= scale).all():
+                facets.append(-n)
+    if len(facets) < 3:
+        return None
+    return np.array(facets)
+
+# Which spheres ((S, 3) centres, (S,) radii) may reach into the cone with
+# apex and facets from _coneFacets. Spheres near the cone's edges can be
+# reported although they only come close.
+def _spheresInCone(centres, radii, apex, facets):
+    if facets is None:
+        return np.ones(len(radii), dtype=bool)
+    distance = (centres - apex).dot(facets.T)
+    return (distance >= -radii[:, np.newaxis] * (1 + 1e-9) - 1e-9).all(axis=1)
+
+def _digest(obj):
+    return hashlib.sha1(pickleContent(obj)).digest()
+
+# Cache keys (hex digests) of the tiles of a w*h frame of scene traced to
+# depth, as a dict by tile. A key covers the camera, the light, the render
+# settings, the tile and the objects relevant to it: those that can lie in
+# the view frustum of the tile (grown by a pixel, for anti-aliasing) or on a
+# shadow ray from there, which runs through the light and on past it. If a
+# reflective object is relevant and depth lets reflection rays hit
+# anything, or the scene has scene.lights or shadow maps, all objects are.
+# Objects without bounds are always relevant.
+def tileKeys(scene, w, h, tiles, depth):
+    camera = scene.camera
+    header = pickle.dumps((CACHE_VERSION, w, h, depth,
+                           tuple(camera.focus), camera.rotation, camera.zoom, camera.FoV,
+                           camera.width, camera.height, tuple(camera.translation),
+                           tuple(camera.topleft), tuple(camera.basic_horizontal),
+                           tuple(camera.basic_vertical), tuple(scene.light), scene.BackgroundColor,
+                           scene.supersampling, scene.adaptive, scene.edgeThreshold,
+                           scene.minContribution, scene.russianRoulette, scene.wavefront,
+                           [(tuple(l.position), l.power, l.halfDistance) for l in scene.lights],
+                           scene.lightThreshold,
+                           scene.shadowMaps is not None and
+                           [(key, m.resolution, m.bias) for key, m in sorted(scene.shadowMaps.items())]),
+                          pickle.HIGHEST_PROTOCOL)
+    objects = scene.objects
+    digests = [_digest(o) for o in objects]
+    spheres = [i for i, o in enumerate(objects) if type(o) == RaycastingSphere]
+    unbounded = np.ones(len(objects), dtype=bool)
+    unbounded[spheres] = False
+    centres = np.array([tuple(objects[i].c) for i in spheres], dtype=np.float64).reshape(-1, 3)
+    radii = np.array([objects[i].r for i in spheres], dtype=np.float64)
+    reflective = np.array([o.reflectionIndex != 0.0 for o in objects], dtype=bool)
+
+    focus = np.array(tuple(camera.focus), dtype=np.float64)
+    light = np.array(tuple(scene.light), dtype=np.float64)
+    topleft = np.array(tuple(camera.topleft), dtype=np.float64)
+    horiz = np.array(tuple(camera.basic_horizontal), dtype=np.float64) / float(w)
+    vert = np.array(tuple(camera.basic_vertical), dtype=np.float64) / float(h)
+    keys = {}
+    for tile in tiles:
+        x0, y0, x1, y1 = tile
+        corners = np.array([topleft + horiz * x + vert * y - focus
+                            for x in (x0 - 1, x1) for y in (y0 - 1, y1)])
+        relevant = unbounded.copy()
+        visible = _spheresInCone(centres, radii, focus, _coneFacets(corners))
+        relevant[spheres] = visible
+        if scene.lights or scene.shadowMaps is not None or \
+           (depth >= 2 and (reflective & relevant).any()):
+            relevant[:] = True
+        else:
+            # shadow rays leave from the frustum towards the light and past it
+            towards = np.vstack((focus - light, corners))
+            shadowed = visible | _spheresInCone(centres, radii, light, _coneFacets(towards)) | \
+                       _spheresInCone(centres, radii, light, _coneFacets(-towards))
+            relevant[spheres] = shadowed
+        key = hashlib.sha1(header)
+        key.update(pickle.dumps(tile, pickle.HIGHEST_PROTOCOL))
+        for i in np.flatnonzero(relevant).tolist():
+            key.update(digests[i])
+        keys[tile] = key.hexdigest()
+    return keys
+
+class TileCache(object):
+    def __init__(self, directory, maxBytes=256 << 20):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".tile")
+
+    # The pixels stored under key, or None.
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                rows = pickle.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted by another process meanwhile
+            pass
+        self.hits += 1
+        return rows
+
+    def put(self, key, rows):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(rows, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, path)
+        except:
+            os.unlink(temp)
+            raise
+
+    # Deletes the least recently used entries until the rest take at most
+    # maxBytes. Entries other processes delete meanwhile are skipped.
+    def evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tile'):
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+                elif name.endswith('.tmp') and now - st.st_mtime > STALE_SECONDS:
+                    self._remove(path)
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,293 @@
+import numpy as np
+from compiled import SPHERE, PLANE
+from shapes import RaycastingSphere, RaycastingPlane
+from packets import spheresOnShadowRays, MIN_SPHERES
+
+# Breadth-first version of Scene.trace over a compiled scene.
+# All rays of a bounce (wave) are intersected, shaded and reflected together
+# with the vectorized kernels; the rays that reflect are compacted into the
+# next wave. Every step repeats the arithmetic of the recursive path
+# (findIntersect, getColor, reflect, blend) in the same order, so both
+# produce the same pixels.
+
+# |v| for an (N, 3) array, computed like euclid's Vector3.__abs__.
+def _magnitude(v):
+    return np.sqrt(v[:, 0] ** 2 + v[:, 1] ** 2 + v[:, 2] ** 2)
+
+# Vector3.normalized() for an (N, 3) array; zero vectors stay as they are.
+def _normalized(v):
+    d = _magnitude(v)
+    return np.where((d != 0)[:, np.newaxis], v / np.where(d != 0, d, 1.0)[:, np.newaxis], v)
+
+def _dot(a, b):
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1] + a[:, 2] * b[:, 2]
+
+# Surface normals at points on objects; spheres as in Scene.getColor.
+def _normals(compiled, points, objects):
+    kinds = compiled.kinds[objects]
+    rows = compiled.objectRow[objects]
+    normals = np.empty_like(points)
+    spheres = kinds == SPHERE
+    normals[spheres] = _normalized(points[spheres] - compiled.centres[rows[spheres]])
+    planes = kinds == PLANE
+    normals[planes] = compiled.normals[rows[planes]]
+    return normals
+
+# spheres: how many spheres each ray was tested against, all by default.
+def _countTests(scene, rays, spheres=None):
+    compiled = scene.compiled
+    tests = scene.stats.rays.tests
+    if spheres is None:
+        spheres = len(compiled.sphereIndex)
+    tests[RaycastingSphere.__name__] += rays * spheres
+    tests[RaycastingPlane.__name__] += rays * len(compiled.planeIndex)
+
+# Scene.findOccluder's penetration statistics for shadow rays (origins,
+# directions) leaving from objects: how far each travels inside the sphere
+# it starts on, as RaycastingSphere.penetration of a Ray3 or, with segment,
+# a LineSegment3 gives it.
+def _addPenetration(scene, origins, directions, objects, segment):
+    compiled = scene.compiled
+    spheres = compiled.kinds[objects] == SPHERE
+    rows = compiled.objectRow[objects[spheres]]
+    p, v = origins[spheres], directions[spheres]
+    centres, radii = compiled.centres[rows], compiled.radii[rows]
+    # euclid.intersect_line3_sphere_span's arithmetic
+    a = v[:, 0] ** 2 + v[:, 1] ** 2 + v[:, 2] ** 2
+    b = 2 * (v[:, 0] * (p[:, 0] - centres[:, 0]) + v[:, 1] * (p[:, 1] - centres[:, 1]) +
+             v[:, 2] * (p[:, 2] - centres[:, 2]))
+    cc = centres[:, 0] ** 2 + centres[:, 1] ** 2 + centres[:, 2] ** 2
+    pp = p[:, 0] ** 2 + p[:, 1] ** 2 + p[:, 2] ** 2
+    det = b ** 2 - 4 * a * (cc + pp - 2 * _dot(centres, p) - radii ** 2)
+    inside = det >= 0
+    sq = np.sqrt(np.where(inside, det, 0.0))
+    u1 = (-b + sq) / (2 * a)
+    u2 = np.maximum((-b - sq) / (2 * a), 0.0)
+    if segment:
+        u1 = np.minimum(u1, 1.0)
+    inside &= u1 >= u2
+    penetration = scene.stats.penetration
+    for length in ((u1 - u2) * np.sqrt(a))[inside].tolist():
+        penetration.add(length)
+
+# Scene.getColor for arrays of points on objects, with intensities.
+# pixel: index of each point's camera ray, for scene.rayLog.
+# Returns the (intensity, rgb) of the resulting RayColors.
+def _shade(scene, points, objects, intensity, pixel):
+    if scene.lights:
+        return _shadeLights(scene, points, objects, intensity, pixel)
+    compiled = scene.compiled
+    counters = scene.stats.rays
+    light = np.array(tuple(scene.light), dtype=np.float64)
+    toLight = light - points
+    if scene.shadowMaps is not None:
+        blocked = scene.shadowMaps[tuple(scene.light)].occluded(points)
+    else:
+        # all shadow rays of the wave as one packet
+        spheres = None
+        if len(compiled.radii) >= MIN_SPHERES:
+            spheres = np.flatnonzero(spheresOnShadowRays(compiled.centres, compiled.radii, light, points,
+                                                         True))
+        t, blocker = compiled.intersect(points, toLight, objects, spheres)
+        log = scene.rayLog
+        if log is not None:
+            log.addRays(log.pixels[pixel], points, toLight, np.inf, log.objectIds(compiled)[blocker])
+        blocked = blocker >= 0
+        _countTests(scene, len(points), None if spheres is None else len(spheres))
+        _addPenetration(scene, points, toLight, objects, False)
+    counters.shadow += len(points)
+    counters.occluded += int(blocked.sum())
+
+    strength = np.abs(_dot(_normalized(toLight), _normals(compiled, points, objects)))
+    rgb = np.where(blocked[:, np.newaxis], 0.0, _colors(compiled, points, objects))
+    return np.where(blocked, intensity, intensity * strength), rgb
+
+# Checker pattern colors of RaycastingPlane.getColor and the spheres'
+# colors for arrays of points on objects.
+def _colors(compiled, points, objects):
+    colors = compiled.colors[objects, 0].astype(np.float64)
+    planes = compiled.kinds[objects] == PLANE
+    if planes.any():
+        rows = compiled.objectRow[objects[planes]]
+        p = points[planes]
+        size = compiled.squareSizes[rows]
+        x = np.trunc((_dot(compiled.axes[rows, 0], p) - 0.5) * size).astype(np.int64)
+        y = np.trunc((_dot(compiled.axes[rows, 1], p) - 0.5) * size).astype(np.int64)
+        even = (x + y) % 2 == 0
+        colors[planes] = compiled.colors[objects[planes], np.where(even, 1, 0)]
+    return colors
+
+# (start, stop) of the runs of equal values in keys.
+def _runs(keys):
+    if not len(keys):
+        return []
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return zip(starts.tolist(), np.r_[starts[1:], len(keys)].tolist())
+
+# _shade with scene.lights, like Scene.getLitColor. The lights are gone
+# through in order, each with the points it may reach; the shadow rays to
+# each light that survive culling make up one packet.
+def _shadeLights(scene, points, objects, intensity, pixel):
+    compiled = scene.compiled
+    counters = scene.stats.rays
+    lights = scene.lights
+    n = len(points)
+    normals = _normals(compiled, points, objects)
+    if scene.lightGrid is None:
+        pointIdx = np.tile(np.arange(n), len(lights))
+        lightIdx = np.repeat(np.arange(len(lights)), n)
+    else:
+        pointIdx, lightIdx = scene.lightGrid.pairs(points)
+    positions = np.array([tuple(l.position) for l in lights], dtype=np.float64).reshape(-1, 3)
+    power = np.array([l.power for l in lights], dtype=np.float64)
+    h2 = np.array([np.nan if l.halfDistance is None else l.halfDistance ** 2 for l in lights])
+    toLight = positions[lightIdx] - points[pointIdx]
+    d2 = toLight[:, 0] ** 2 + toLight[:, 1] ** 2 + toLight[:, 2] ** 2
+    falloff = np.where(np.isnan(h2[lightIdx]), 1.0, h2[lightIdx] / (h2[lightIdx] + d2))
+    strength = power[lightIdx] * np.abs(_dot(_normalized(toLight), normals[pointIdx])) * falloff
+    keep = intensity[pointIdx] * strength >= scene.lightThreshold
+    counters.culled += n * len(lights) - int(keep.sum())
+    pointIdx, lightIdx, toLight, strength = pointIdx[keep], lightIdx[keep], toLight[keep], strength[keep]
+
+    if scene.shadowMaps is not None:
+        t = np.zeros(len(pointIdx))
+        blocker = np.full(len(pointIdx), -1, dtype=np.intp)
+        for start, stop in _runs(lightIdx):
+            shadowMap = scene.shadowMaps[tuple(positions[lightIdx[start]].tolist())]
+            # any object will do, there is no rayLog with shadow maps
+            blocker[start:stop][shadowMap.occluded(points[pointIdx[start:stop]])] = 0
+    elif len(compiled.radii) < MIN_SPHERES:
+        t, blocker = compiled.intersect(points[pointIdx], toLight, objects[pointIdx])
+        tests = len(pointIdx) * len(compiled.radii)
+    else:
+        t = np.empty(len(pointIdx))
+        blocker = np.empty(len(pointIdx), dtype=np.intp)
+        tests = 0
+        for start, stop in _runs(lightIdx):
+            packet = pointIdx[start:stop]
+            spheres = np.flatnonzero(spheresOnShadowRays(compiled.centres, compiled.radii,
+                                                         positions[lightIdx[start]], points[packet], False))
+            t[start:stop], blocker[start:stop] = compiled.intersect(points[packet], toLight[start:stop],
+                                                                    objects[packet], spheres)
+            tests += (stop - start) * len(spheres)
+    # the shadow rays end at the lights
+    blocker[t > 1.0] = -1
+    if scene.shadowMaps is None:
+        _addPenetration(scene, points[pointIdx], toLight, objects[pointIdx], True)
+    log = scene.rayLog
+    if log is not None:
+        log.addRays(log.pixels[pixel[pointIdx]], points[pointIdx], toLight, 1.0,
+                    log.objectIds(compiled)[blocker])
+    reaches = blocker < 0
+    counters.shadow += len(pointIdx)
+    counters.occluded += len(pointIdx) - int(reaches.sum())
+    if scene.shadowMaps is None:
+        counters.tests[RaycastingSphere.__name__] += tests
+        counters.tests[RaycastingPlane.__name__] += len(pointIdx) * len(compiled.planeIndex)
+
+    # add up in light order, as getLitColor does
+    total = np.zeros(n)
+    lit = np.zeros(n, dtype=bool)
+    pointIdx, strength = pointIdx[reaches], strength[reaches]
+    for start, stop in _runs(lightIdx[reaches]):
+        total[pointIdx[start:stop]] += strength[start:stop]
+    lit[pointIdx] = True
+    rgb = np.where(lit[:, np.newaxis], _colors(compiled, points, objects), 0.0)
+    return np.where(lit, intensity * total, intensity), rgb
+
+# reflect() for arrays of hit points on objects and incoming directions.
+def _reflect(compiled, points, objects, directions):
+    n = _normals(compiled, points, objects)
+    v = -_normalized(directions)
+    s = 2 * _dot(n, v)
+    return s[:, np.newaxis] * n - v
+
+# Traces rays given as (N, 3) origin/direction arrays through scene, which
+# must be compiled, like Scene.trace(ray, 1.0, depth) does for each,
+# including scene.minContribution pruning. seed seeds the Russian roulette.
+# Returns the (N,) intensities and (N, 3) rgb of the resulting RayColors,
+# and the (N,) index of the object each ray hit first (-1 for none).
+def traceWavefront(scene, origins, directions, depth, seed=None):
+    compiled = scene.compiled
+    if compiled is None or compiled.others:
+        raise TypeError("Wavefront tracing needs a compiled scene of spheres and planes")
+    background = np.array(scene.BackgroundColor, dtype=np.float64)
+    counters = scene.stats.rays
+    n = len(origins)
+    pixel = np.arange(n)
+    origins = np.asarray(origins, dtype=np.float64)
+    directions = np.asarray(directions, dtype=np.float64)
+    intensity = np.ones(n)
+    rng = np.random.RandomState(seed)
+    previous = np.full(n, -1, dtype=np.intp)
+    first = previous.copy()
+    # per wave: (pixel, local intensity, local rgb, reflected)
+    waves = []
+    for level in xrange(depth):
+        if not len(pixel):
+            break
+        t, hit = compiled.intersect(origins, directions, previous)
+        _countTests(scene, len(pixel))
+        if not level:
+            first = hit
+        log = scene.rayLog
+        if log is not None:
+            log.addRays(log.pixels[pixel], origins, directions, t, log.objectIds(compiled)[hit])
+        hits = hit >= 0
+        counters.hits += int(hits.sum())
+        counters.misses += len(pixel) - int(hits.sum())
+
+        localI = intensity.copy()
+        localRGB = np.empty((len(pixel), 3))
+        localRGB[:] = background
+        points = origins + t[:, np.newaxis] * directions
+        # a miss shades the object the ray left from, at the ray's origin
+        missPrevious = ~hits & (previous >= 0)
+        shadePoints = np.where(missPrevious[:, np.newaxis], origins, points)
+        shadeObjects = np.where(hits, hit, previous)
+        shaded = hits | missPrevious
+        reflection = np.where(hits, compiled.reflection[np.maximum(hit, 0)], 0.0)
+        reflective = hits & (reflection != 0.0)
+        shadeIntensity = np.where(reflective, (1 - reflection) * intensity, intensity)
+        if shaded.any():
+            localI[shaded], localRGB[shaded] = _shade(scene, shadePoints[shaded], shadeObjects[shaded],
+                                                      shadeIntensity[shaded], pixel[shaded])
+        reflected = intensity * reflection
+        reflects = reflective
+        faint = reflective & (reflected < scene.minContribution)
+        if faint.any():
+            if scene.russianRoulette:
+                survival = reflected / scene.minContribution
+                survives = faint & (rng.random_sample(len(pixel)) < survival)
+                reflected = np.where(survives, scene.minContribution, reflected)
+                faint &= ~survives
+            reflects = reflective & ~faint
+            counters.pruned += int(faint.sum())
+        waves.append((pixel, localI, localRGB, reflects))
+
+        # compact the reflected rays into the next wave
+        if level + 1 < depth:
+            # the last wave's reflections get the background without being traced
+            counters.reflection += int(reflects.sum())
+        directions = _reflect(compiled, points[reflects], hit[reflects], directions[reflects])
+        origins = points[reflects]
+        intensity = reflected[reflects]
+        previous = hit[reflects]
+        pixel = pixel[reflects]
+
+    # rays still alive once depth runs out get the background color
+    resultI = np.zeros(n)
+    resultRGB = np.zeros((n, 3))
+    resultI[pixel] = intensity
+    resultRGB[pixel] = background
+    # fold the waves back up like the recursion's blend() calls
+    for pixel, localI, localRGB, reflects in reversed(waves):
+        leaf = pixel[~reflects]
+        resultI[leaf] = localI[~reflects]
+        resultRGB[leaf] = localRGB[~reflects]
+        blended = pixel[reflects]
+        childI = resultI[blended]
+        i = localI[reflects]
+        resultRGB[blended] = localRGB[reflects] * i[:, np.newaxis] + resultRGB[blended] * childI[:, np.newaxis]
+        resultI[blended] = i + childI
+    return resultI, resultRGB, first